@@ -1,4 +1,4 @@
-import sys, os, re
+import sys, os, re, gzip, json, hashlib
 from posixpath import basename, join, splitext
 from datetime import datetime, timedelta
 from argparse import ArgumentParser
@@ -15,6 +15,9 @@ from sklearn.model_selection import cross_val_score
 import hail as hl
 import hailtop.fs as hlfs
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+from bgzf_io import BgzfReader, BgzfWriter, parse_index, seek_offset
+
 
 ### Arguments
 def make_argparse():
@@ -42,6 +45,8 @@ def make_argparse():
                             help='sample vcf, if supplied will have ancestry inferred; supersedes -S')
     file1_args.add_argument('-S', '--vcf-list', action='store_true',
                             help='flag, if provided `--sample-vcf` will be interpreted as a text file listing vcf file names, one per line, to process')
+    file1_args.add_argument('--batch-size', default=100, type=int,
+                            help='with -S, number of vcfs imported together as one MatrixTable')
 
     buildref_clap.add_argument('-c', '--pop-col', required=True, type=int,
                             help='column with population class in population-tsv')
@@ -64,11 +69,22 @@ def make_argparse():
     file2_args.add_argument('sample-vcf',
                             help='sample cohort VCF')
     file2_args.add_argument('refloadings',
-                            help='Hail table with reference pc loadings and afs, (note: cannot read from local file system)')
-    file2_args.add_argument('refRFmodel',
-                            help='joblib dump of a sklearn RandomForestClassifier trained on reference PCs -> population class')
+                            help='reference bundle manifest (.reference.json) written by build-reference, '
+                                 'or a Hail table with reference pc loadings and afs, (note: cannot read from local file system)')
+    file2_args.add_argument('refRFmodel', nargs='?', default=None,
+                            help='joblib dump of a sklearn RandomForestClassifier trained on reference PCs -> population class, '
+                                 'defaults to the one of the reference bundle')
     file2_args.add_argument('-S', '--vcf-list', action='store_true',
                             help='if provided, `sample-vcf` will be interpreted as a text file listing vcf file names, one per line, to process')
+    file2_args.add_argument('--batch-size', default=100, type=int,
+                            help='with -S, number of vcfs imported together as one MatrixTable')
+
+    engine_args = infer_clap.add_argument_group('Engine')
+    engine_args.add_argument('-e', '--engine', default='auto', choices=['auto', 'hail', 'numpy'],
+                             help='projection engine; numpy streams the vcfs without Spark and needs a reference bundle, '
+                                  'auto uses it for a bundle and at most --numpy-max-samples samples')
+    engine_args.add_argument('--numpy-max-samples', default=200, type=int,
+                             help='largest cohort (samples over all vcfs) auto projects with numpy')
     return clap
 
 # Defaults for interactive usage
@@ -102,6 +118,13 @@ def run(args):
     config['datadir'] = join(config['bucket'], 'hail', 'data')
     config['start'] = datetime.now()
 
+    # small cohorts are projected before Spark would even be up
+    if config['proc'] == 'infer-samples' and pick_engine() == 'numpy':
+        bundle, rf = load_reference(config['refloadings'], config['refRFmodel'])
+        infer_samples_numpy(config['sample-vcf'], bundle, rf, vcf_list=config['vcf_list'])
+        stamp('Done! bye-bye ☻')
+        return
+
     sconf = dict(pair.split('=') for pair in config['spark_conf'].split())
     hl.init(app_name='PCA-RF',
             quiet=True,
@@ -112,10 +135,12 @@ def run(args):
     if config['proc'] == 'build-reference':
         ref_loadings_ht, rf = build_reference(config['reference-vcf'], config['population-tsv'], config['pop_col'])
         if config['sample_vcf'] != None:
-            infer_samples(config['sample_vcf'], ref_loadings_ht, rf, vcf_list=config['vcf_list'])
+            infer_samples(config['sample_vcf'], ref_loadings_ht, rf,
+                          vcf_list=config['vcf_list'], batch=config['batch_size'])
     elif config['proc'] == 'infer-samples':
-        ref_loadings_ht, rf = load_models(config['refloadings'], config['refRFmodel'])
-        infer_samples(config['sample-vcf'], ref_loadings_ht, rf, vcf_list=config['vcf_list'])
+        ref_loadings_ht, rf, sites = load_models(config['refloadings'], config['refRFmodel'])
+        infer_samples(config['sample-vcf'], ref_loadings_ht, rf, sites=sites,
+                      vcf_list=config['vcf_list'], batch=config['batch_size'])
     
     stamp('Done! bye-bye ☻')
 
@@ -127,72 +152,135 @@ def build_reference(refvcf, refpoptsv, pop_col):
     config['filebase'] = re.sub(r"\.[bv]cf\.gz", "", basename(refvcf))
     display_spark_config(mkfname('.config.txt'))
     file_stages = ['unprocessed.mt', 'filtered.mt', ['pcs.ht', 'loadings.ht']]
-    progress = resume(file_stages)
-    
+    bases = stage_bases(refvcf)
+    progress = resume(file_stages, bases)
+    stamp(f'{progress} of {len(file_stages)} stages cached')
+
+    # each stage reads its own checkpoint back when it has one, so only
+    # those feeding a missing checkpoint are run
     mt = None
-    if progress < 1:
+    if progress < 2:
         stamp('Importing variants')
         mt = import_variants(refvcf, config['reference'],
-                             cpn='unprocessed.mt')
+                             cpn='unprocessed.mt', base=bases[0])
 
-    if progress < 2:
+    if progress < 3:
         stamp('Filtering')
         mt = prep_mt_pca(mt, config['af_min'], config['hwe_p'], config['ld_r2'],
-                         cpn='filtered.mt')
-    
-    pcs_ht, loadings_ht = None, None
-    if progress < 3:
-        stamp('PCA')
-        pcs_ht, loadings_ht = do_pca(mt, config['k'],
-                                     cpn=['pcs.ht', 'loadings.ht'])
+                         cpn='filtered.mt', base=bases[1])
+
+    stamp('PCA')
+    pcs_ht, loadings_ht = do_pca(mt, config['k'],
+                                 cpn=['pcs.ht', 'loadings.ht'], base=bases[2])
 
     stamp('Preparing random forest data')
     df = prep_df_rf(pcs_ht, refpoptsv, pop_col, config['k'])
 
     stamp('Planting forest')
     rf = make_rf_model(df, config['k'])
+
+    stamp('Exporting reference bundle')
+    export_bundle(loadings_ht, refvcf, refpoptsv)
     
     stamp('Reference model complete')
     return loadings_ht, rf
 
 
-def infer_samples(samplevcf, ref_loadings_ht: hl.Table, rf: RandomForestClassifier, vcf_list=False):
+def infer_samples(samplevcf, ref_loadings_ht: hl.Table, rf: RandomForestClassifier, sites=None, vcf_list=False, batch=100):
     if vcf_list:
         stamp('Reading sample vcf list')
         listbase = splitext(basename(samplevcf))[0]
-        with open(samplevcf) as inp:
-            vcfs = [v.strip() for v in inp.readlines() if len(v)]
-        
+        vcfs = read_vcf_list(samplevcf)
+
+        # read the loadings once, not once per vcf
+        ref_loadings_ht = ref_loadings_ht.select('loadings', 'af').persist()
+        if sites is None:
+            sites = loading_sites(ref_loadings_ht)
+
         parts = []
-        for vcf in vcfs:
-            parts.append(infer_samples(vcf, ref_loadings_ht, rf))
-        
-        stamp('Combining and writing full result set')
-        full_df = pd.concat(parts)
+        for i in range(0, len(vcfs), batch):
+            group = vcfs[i:i+batch]
+            stamp(f'Projecting vcfs {i+1}-{i+len(group)} of {len(vcfs)}')
+            sample_mt = union_samples([import_samples(vcf, ref_loadings_ht, sites) for vcf in group])
+            scores_ht = project_samples(sample_mt, ref_loadings_ht)
+            parts.append(scores_ht.checkpoint(mkfname(f'scores.{i//batch}.ht', listbase), overwrite=True))
+
+        stamp(f"Writing combined scores to {mkfname('scores.ht', listbase)}")
+        scores_ht = parts[0].union(*parts[1:]).checkpoint(mkfname('scores.ht', listbase), overwrite=True)
+
+        full_df = classify_samples(scores_ht, rf)
+
+        stamp('Writing full result set')
         full_df.to_csv(f'{listbase}.all.pca_pop.tsv', sep='\t')
         stamp('All vcfs complete')
         return full_df
 
     stamp(f'Beginning sample inference on {samplevcf}', True)
     samplebase = re.sub("\.[bv]cf\.gz", "", basename(samplevcf))
-    sample_mt = hl.import_vcf(samplevcf, force_bgz=samplevcf.endswith('.gz'), reference_genome=config['reference'])
+    if sites is None:
+        sites = loading_sites(ref_loadings_ht)
+    sample_mt = import_samples(samplevcf, ref_loadings_ht, sites)
 
     stamp('Projecting samples with reference weights...')
-    sample_pcs_ht = hl.experimental.pc_project(sample_mt.GT, ref_loadings_ht.loadings, ref_loadings_ht.af)
+    sample_pcs_ht = project_samples(sample_mt, ref_loadings_ht)
+
+    sample_data = classify_samples(sample_pcs_ht, rf)
 
+    stamp('Writing result')
+    sample_data.to_csv(f'{samplebase}.pca_pop.tsv', sep='\t')
+    stamp('Sample ancestry inference complete')
+    return sample_data
+
+# only the genotypes at loadings sites, `present` marking the vcf's own sites in a union
+def import_samples(samplevcf, ref_loadings_ht: hl.Table, sites):
+    # unique per call, scattered shards often share a basename and a
+    # batch's vcfs are only read once it is checkpointed
+    samplebase = re.sub(r"\.[bv]cf(\.b?gz)?$", "", basename(samplevcf))
+    sitesvcf = hl.utils.new_temp_file(prefix=f'{samplebase}.sites', extension='vcf.bgz')
+    if samplevcf.endswith(('.gz', '.bgz')) and (n := extract_sites(samplevcf, sites, sitesvcf)) is not None:
+        stamp(f'{n} records of {samplevcf} at loadings sites')
+        samplevcf = sitesvcf
+        mt = hl.import_vcf(samplevcf,
+                           reference_genome=config['reference'],
+                           array_elements_required=False)
+    else:
+        mt = hl.import_vcf(samplevcf,
+                           force_bgz=samplevcf.endswith('.gz'),
+                           reference_genome=config['reference'],
+                           array_elements_required=False)
+        mt = mt.semi_join_rows(ref_loadings_ht)
+    mt = mt.select_rows().select_cols()
+    return mt.select_entries(GT=mt.GT, present=True)
+
+# pairwise, so the plan is log2(len(mts)) joins deep
+def union_samples(mts: Sequence[hl.MatrixTable]):
+    while len(mts) > 1:
+        mts = [mts[i].union_cols(mts[i+1], row_join_type='outer') if i+1 < len(mts) else mts[i]
+               for i in range(0, len(mts), 2)]
+    return mts[0]
+
+# pc_project normalizing each sample by the loadings sites of its own vcf
+def project_samples(sample_mt: hl.MatrixTable, ref_loadings_ht: hl.Table):
+    mt = sample_mt.annotate_rows(**ref_loadings_ht.select('loadings', 'af')[sample_mt.row_key])
+    mt = mt.filter_rows(hl.is_defined(mt.loadings) & hl.is_defined(mt.af) & (mt.af > 0) & (mt.af < 1))
+    gt_norm = (mt.GT.n_alt_alleles() - 2 * mt.af) / hl.sqrt(2 * mt.af * (1 - mt.af))
+    scores_ht = mt.select_cols(scores=hl.agg.array_sum(mt.loadings * gt_norm),
+                               n=hl.agg.count_where(hl.is_defined(mt.present))).cols()
+    return scores_ht.select(scores=scores_ht.scores.map(lambda x: x / hl.sqrt(scores_ht.n)))
+
+def classify_samples(scores_ht: hl.Table, rf: RandomForestClassifier):
     stamp('Preparing RandomForest input')
     PCs = PCcols(rf.n_features_in_)
-    sample_data = sample_pcs_ht.to_pandas()
+    sample_data = scores_ht.to_pandas()
     sample_data.set_index('s', inplace=True)
     sample_data.index.name = 'Sample'
     sample_data = sample_data['scores'].apply(lambda x: pd.Series(x, index=PCs))
+    return predict_populations(sample_data, rf)
 
+def predict_populations(sample_data: pd.DataFrame, rf: RandomForestClassifier):
+    PCs = PCcols(rf.n_features_in_)
     stamp('Shaking trees')
     sample_data['Population'] = rf.predict(sample_data[PCs])
-    
-    stamp('Writing result')
-    sample_data.to_csv(f'{samplebase}.pca_pop.tsv', sep='\t')
-    stamp('Sample ancestry inference complete')
     return sample_data
 
 
@@ -219,7 +307,10 @@ def stage(f: Callable[..., Sequence[hlo] | hlo]):
             out = f(*args, **kwargs)
             outs = [out] if not isinstance(out, Sequence) else out
             for fn, o in zip(cpfns, outs): write_to(fn, o)
-        
+            # continue from the written tables, not the pipeline that made them
+            outs = [read_from(fn) for fn in cpfns]
+            out = outs[0] if len(outs) == 1 else outs
+
         return out
     return checkpoint
 
@@ -227,13 +318,10 @@ def stage(f: Callable[..., Sequence[hlo] | hlo]):
 @stage
 def import_variants(vcf, reference='GRCh38'):
     stamp('Converting VCF to MatrixTable')
-    hl.import_vcf(vcf,
-                  force_bgz=vcf.endswith('.gz'),
-                  reference_genome=reference,
-                  array_elements_required=False)\
-        .write('cvt.mt', overwrite=True)
-    stamp('Reading variant matrix')
-    return hl.read_matrix_table('cvt.mt')
+    return hl.import_vcf(vcf,
+                         force_bgz=vcf.endswith('.gz'),
+                         reference_genome=reference,
+                         array_elements_required=False)
 
 @stage
 def prep_mt_pca(mt: hl.MatrixTable, aft=0.01, hwe_pt=1e-6, ld_r2=0.1):
@@ -302,16 +390,298 @@ def make_rf_model(df: pd.DataFrame, k=5):
 
     return rf
 
-def load_models(refloadings, refRF):
+# loadings sites are None for a Hail table, they are collected when needed
+def load_models(refloadings, refRF=None):
+    if refloadings.endswith('.json'):
+        bundle, rf = load_reference(refloadings, refRF)
+        return bundle_table(bundle), rf, bundle_sites(bundle)
+
     stamp(f'Loading referencing weights from {refloadings}')
     ref_loadings_ht = hl.read_table(refloadings)
+    if refRF is None:
+        print("A Random Forest model is needed with a Hail loadings table.", file=sys.stderr)
+        sys.exit(1)
     rf: RandomForestClassifier = load(refRF)
+    check_pcs(rf, len(ref_loadings_ht.loadings.take(1)[0]))
+    return ref_loadings_ht, rf, None
+
+def load_reference(manifest, refRF=None):
+    stamp(f'Loading reference bundle {manifest}')
+    bundle = load_bundle(manifest)
+    rf = load(refRF) if refRF is not None else bundle['rf']
+    if bundle['reference'] != config['reference']:
+        print(f"Reference bundle is on {bundle['reference']}, not {config['reference']}.", file=sys.stderr)
+        sys.exit(1)
+    check_pcs(rf, bundle['k'])
+    return bundle, rf
 
-    if rf.n_features_in_ != (nL := len(ref_loadings_ht.loadings.take(1)[0])):
+def check_pcs(rf: RandomForestClassifier, nL):
+    if rf.n_features_in_ != nL:
         print(f"Number of Random Forest PC features {rf.n_features_in_} disagrees with number in reference loadings {nL}.", file=sys.stderr)
         sys.exit(1)
-    
-    return ref_loadings_ht, rf
+
+### Reference bundle
+# <filebase>.reference.npz + .json manifest, so load_bundle needs no Spark;
+# the npz holds contig (index into contigs), pos, loadings, af and 'REF,ALT' alleles per site
+def export_bundle(loadings_ht: hl.Table, refvcf, refpoptsv):
+    rows = loadings_ht.select('loadings', 'af').collect()
+    contigs = list(dict.fromkeys(r.locus.contig for r in rows))
+    cidx = {c: i for i, c in enumerate(contigs)}
+    alleles = '\n'.join(','.join(r.alleles) for r in rows).encode()
+
+    arrays = f"{config['filebase']}.reference.npz"
+    np.savez(arrays,
+             contigs=np.array(contigs),
+             contig=np.array([cidx[r.locus.contig] for r in rows], dtype=np.int16),
+             pos=np.array([r.locus.position for r in rows], dtype=np.int32),
+             alleles=np.frombuffer(alleles, dtype=np.uint8),
+             loadings=np.array([r.loadings for r in rows], dtype=np.float64).reshape(len(rows), config['k']),
+             af=np.array([r.af for r in rows], dtype=np.float64))
+
+    manifest = {
+        'format': 1,
+        'arrays': basename(arrays),
+        'rf': f"{config['filebase']}.pop_rf.sklearn.joblib",
+        'sites': len(rows),
+        'reference': config['reference'],
+        'k': config['k'],
+        'af_min': config['af_min'],
+        'hwe_p': config['hwe_p'],
+        'ld_r2': config['ld_r2'],
+        'reference_vcf': refvcf,
+        'population_tsv': refpoptsv,
+        'pop_col': config['pop_col'],
+        'created': datetime.now().isoformat(timespec='seconds')
+    }
+    with open(f"{config['filebase']}.reference.json", 'w') as out:
+        json.dump(manifest, out, indent=2)
+
+# paths in the manifest are relative to it
+def load_bundle(manifest):
+    with open(manifest) as inp:
+        bundle = json.load(inp)
+    where = os.path.dirname(manifest)
+    with np.load(os.path.join(where, bundle['arrays'])) as arrays:
+        bundle.update({k: arrays[k] for k in arrays.files})
+    bundle['rf'] = load(os.path.join(where, bundle['rf']))
+
+    if bundle['loadings'].shape != (bundle['sites'], bundle['k']):
+        raise ValueError(f"{manifest}: loadings are {bundle['loadings'].shape}, "
+                         f"expected {bundle['sites']} sites by {bundle['k']} PCs")
+    return bundle
+
+def bundle_alleles(bundle):
+    return bundle['alleles'].tobytes().decode().split('\n')
+
+def bundle_sites(bundle):
+    sites = {}
+    for i, c in enumerate(bundle['contigs']):
+        sites[str(c)] = np.unique(bundle['pos'][bundle['contig'] == i]).tolist()
+    return sites
+
+# the loadings as the Hail table pc_project takes
+def bundle_table(bundle) -> hl.Table:
+    contigs = [str(c) for c in bundle['contigs']]
+    rows = [{'locus': hl.Locus(contigs[c], p, config['reference']),
+             'alleles': a.split(','),
+             'loadings': l,
+             'af': f}
+            for c, p, a, l, f in zip(bundle['contig'].tolist(), bundle['pos'].tolist(), bundle_alleles(bundle),
+                                     bundle['loadings'].tolist(), bundle['af'].tolist())]
+    schema = hl.tstruct(locus=hl.tlocus(config['reference']), alleles=hl.tarray(hl.tstr),
+                        loadings=hl.tarray(hl.tfloat64), af=hl.tfloat64)
+    return hl.Table.parallelize(rows, schema, key=['locus', 'alleles'])
+
+### NumPy engine
+# auto picks numpy for a bundle, unless the vcfs have too many samples
+def pick_engine():
+    bundle = config['refloadings'].endswith('.json')
+    if config['engine'] == 'numpy' and not bundle:
+        print("The numpy engine needs a reference bundle (.reference.json).", file=sys.stderr)
+        sys.exit(1)
+    if config['engine'] != 'auto':
+        return config['engine']
+    if not bundle:
+        return 'hail'
+
+    vcfs = read_vcf_list(config['sample-vcf']) if config['vcf_list'] else [config['sample-vcf']]
+    n = 0
+    for vcf in vcfs:
+        n += len(vcf_samples(vcf))
+        if n > config['numpy_max_samples']:
+            return 'hail'
+    return 'numpy'
+
+def infer_samples_numpy(samplevcf, bundle, rf: RandomForestClassifier, vcf_list=False):
+    if vcf_list:
+        vcfs = read_vcf_list(samplevcf)
+        out = f'{splitext(basename(samplevcf))[0]}.all.pca_pop.tsv'
+    else:
+        vcfs = [samplevcf]
+        samplebase = re.sub("\.[bv]cf\.gz", "", basename(samplevcf))
+        out = f'{samplebase}.pca_pop.tsv'
+
+    PCs = PCcols(bundle['k'])
+    parts = []
+    for vcf in vcfs:
+        stamp(f'Projecting {vcf} with reference weights...')
+        samples, scores = numpy_project(vcf, bundle)
+        parts.append(pd.DataFrame(scores, index=pd.Index(samples, name='Sample'), columns=PCs))
+
+    sample_data = predict_populations(pd.concat(parts), rf)
+
+    stamp('Writing result')
+    sample_data.to_csv(out, sep='\t')
+    stamp('Sample ancestry inference complete')
+    return sample_data
+
+# pc_project without Hail, `chunk` records at a time, reading only sites if the vcf is indexed
+def numpy_project(samplevcf, bundle, chunk=4096):
+    af = bundle['af']
+    usable = np.isfinite(af) & (af > 0) & (af < 1)
+    contigs = [str(c) for c in bundle['contigs']]
+    keys = {f'{contigs[c]}\t{p}\t{a}'.encode(): i
+            for i, (c, p, a) in enumerate(zip(bundle['contig'].tolist(), bundle['pos'].tolist(), bundle_alleles(bundle)))
+            if usable[i]}
+    scale = np.zeros_like(af)
+    scale[usable] = 1 / np.sqrt(2 * af[usable] * (1 - af[usable]))
+    loadings = bundle['loadings']
+
+    index = read_vcf_index(samplevcf) if samplevcf.endswith(('.gz', '.bgz')) else None
+    lines = indexed_records(samplevcf, index, bundle_sites(bundle)) if index is not None else vcf_lines(samplevcf)
+
+    samples, scores = None, None
+    doses, rows = None, []
+    n = 0
+    lut = {}
+
+    def project():
+        # missing genotypes are left out of the sums, as in pc_project
+        g = doses[:len(rows)]
+        z = (g - 2 * af[rows, None]) * scale[rows, None]
+        z[np.isnan(z)] = 0
+        scores[...] += z.T @ loadings[rows]
+
+    for line in lines:
+        if line.startswith(b'##'): continue
+        if line.startswith(b'#'):
+            samples = line.rstrip(b'\r\n').decode().split('\t')[9:]
+            scores = np.zeros((len(samples), loadings.shape[1]))
+            doses = np.empty((chunk, len(samples)))
+            continue
+
+        c, p, _, ref, alt, rest = line.split(b'\t', 5)
+        i = keys.get(b'\t'.join([c, p, ref + b',' + alt]))
+        if i is None: continue
+
+        fields = rest.rstrip(b'\r\n').split(b'\t')
+        form = fields[3].split(b':')
+        if b'GT' not in form:
+            gts = [b'.'] * len(samples)
+        elif form[0] == b'GT':
+            gts = [f.partition(b':')[0] for f in fields[4:]]
+        else:
+            gi = form.index(b'GT')
+            gts = [f.split(b':')[gi] if f.count(b':') >= gi else b'.' for f in fields[4:]]
+        doses[len(rows)] = [lut[g] if g in lut else lut.setdefault(g, dosage(g)) for g in gts]
+        rows.append(i)
+        n += 1
+        if len(rows) == chunk:
+            project()
+            rows = []
+    if rows:
+        project()
+
+    if not n:
+        raise ValueError(f'No records of {samplevcf} are at reference loadings sites')
+    return samples, scores / np.sqrt(n)
+
+# NaN if any allele is missing
+def dosage(gt: bytes):
+    als = gt.replace(b'|', b'/').split(b'/')
+    if not gt or b'.' in als:
+        return np.nan
+    return float(sum(a != b'0' for a in als))
+
+def read_vcf_list(fn):
+    with open(fn) as inp:
+        return [v.strip() for v in inp.readlines() if len(v.strip())]
+
+def vcf_lines(vcf):
+    with hlfs.open(vcf, 'rb') as raw:
+        inp = gzip.GzipFile(fileobj=raw) if vcf.endswith(('.gz', '.bgz')) else raw
+        yield from inp
+
+def vcf_samples(vcf):
+    for line in vcf_lines(vcf):
+        if line.startswith(b'#CHROM'):
+            return line.rstrip(b'\r\n').decode().split('\t')[9:]
+    return []
+
+
+### Site extraction
+def loading_sites(ref_loadings_ht: hl.Table):
+    stamp('Collecting loadings sites')
+    sites = {}
+    for locus in ref_loadings_ht.locus.collect():
+        sites.setdefault(locus.contig, set()).add(locus.position)
+    return {c: sorted(ps) for c, ps in sites.items()}
+
+# None if the vcf has no index
+def extract_sites(vcf, sites, out):
+    index = read_vcf_index(vcf)
+    if index is None: return None
+
+    n = 0
+    with BgzfWriter(hlfs.open(out, 'wb')) as bgz:
+        for line in indexed_records(vcf, index, sites):
+            bgz.write(line)
+            n += not line.startswith(b'#')
+    return n
+
+# seeks on reaching a contig, then only when the next site is past the reader
+def indexed_records(vcf, index, sites):
+    with hlfs.open(vcf, 'rb') as inp:
+        reader = BgzfReader(inp)
+        while (line := reader.readline()).startswith(b'#'):
+            yield line
+        held = line
+
+        for contig in index[2]:
+            if contig not in sites: continue
+            bcontig = contig.encode()
+            # a line of any other contig says nothing about where this one is
+            fresh = held is None or not held.startswith(bcontig + b'\t')
+            for pos in sites[contig]:
+                voff = seek_offset(index, contig, pos)
+                if voff is None: continue
+                if fresh or voff > reader.tell():
+                    reader.seek(voff)
+                    held = None
+                    fresh = False
+                # records from held on, up to the first one past pos
+                while True:
+                    line = held if held is not None else reader.readline()
+                    held = None
+                    if not line: break
+                    c, p, _ = line.split(b'\t', 2)
+                    if c != bcontig:
+                        held = line
+                        break
+                    p = int(p)
+                    if p > pos:
+                        held = line
+                        break
+                    if p == pos:
+                        yield line
+
+def read_vcf_index(vcf):
+    for ext, csi in (('.csi', True), ('.tbi', False)):
+        if hlfs.exists(vcf + ext):
+            with hlfs.open(vcf + ext, 'rb') as inp:
+                return parse_index(gzip.decompress(inp.read()), csi)
+    return None
+
 
 ### Utilities
 def PCcols(n):
@@ -322,13 +692,26 @@ def mkfname(fn, base=None):
     if base is None: base = config['filebase']
     return join(config['datadir'], base + '.' + fn)
 
-def resume(stages):
-    for i, stagef in enumerate(stages):
+# number of leading stages whose checkpoints all exist
+def resume(stages, bases=None):
+    if bases is None: bases = [None] * len(stages)
+    for i, (stagef, base) in enumerate(zip(stages, bases)):
         if isinstance(stagef, str): stagef = [stagef]
-        rfns = [mkfname(s) for s in stagef]
+        rfns = [mkfname(s, base) for s in stagef]
         if not all(hlfs.exists(fn) for fn in rfns):
-            break
-    return i-1
+            return i
+    return len(stages)
+
+# each stage's key hashes its parameters onto the one before, so a change misses from there on
+def stage_bases(refvcf):
+    st = hlfs.stat(refvcf)
+    imported = cache_key(refvcf, st.size, st.modification_time, config['reference'])
+    filtered = cache_key(imported, config['af_min'], config['hwe_p'], config['ld_r2'])
+    pca = cache_key(filtered, config['k'])
+    return [f"{config['filebase']}.{key}" for key in (imported, filtered, pca)]
+
+def cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()[:12]
 
 def stamp(*message, fulltime=False):
     ct = datetime.now()
@@ -1,24 +1,24 @@
 from gzip import open as gzopen
-from multiprocessing import Pool, Lock
-import sys, os, re, sqlite3
-from os.path import basename, exists
+from multiprocessing import Pool
+from argparse import ArgumentParser
+import sys, os, re, sqlite3, random, math
+from os.path import basename, exists, getsize, abspath, dirname, join
 from functools import partial
+from time import perf_counter
 
 from collections import defaultdict as ddict, Counter
 
-# name
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'scripts'))
+from bgzf_io import is_bgzf, block_size, next_block, bgzf_records, parse_index, index_spans
+
+# cid, name, loci
 _ADD_CONTIG_ = """
-INSERT INTO contig (name) VALUES (?)
-"""
-_SET_COUNT_ = """
-UPDATE contig
-SET loci = ?
-WHERE cid = ?
+INSERT INTO contig (cid, name, loci) VALUES (?, ?, ?)
 """
 
-# data, sample column, locus line
+# data, sample column, locus line, rule id
 _ADD_ISSUE_ = """
-INSERT INTO issue VALUES (?, ?, ?)
+INSERT INTO issue VALUES (?, ?, ?, ?)
 """
 # line, contig id, position, format
 _ADD_LOCUS_ = """
@@ -28,143 +28,469 @@ INSERT INTO locus VALUES (?, ?, ?, ?)
 _ADD_SAMPLE_ = """
 INSERT INTO sample VALUES (?, ?)
 """
+# rid, name, issues, seconds
+_ADD_RULE_ = """
+INSERT INTO rule VALUES (?, ?, ?, ?)
+"""
+# stratum, rule id, blocks, records, issues, issues per record, ci low, ci high, estimated records
+_ADD_ESTIMATE_ = """
+INSERT INTO estimate VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# z of the two sided 95% confidence intervals of sampled rates
+_Z_ = 1.96
+# bytes per sampled window of an uncompressed VCF, about one BGZF block
+_WINDOW_ = 1 << 16
+
+def make_argparse():
+  clap = ArgumentParser(prog='check_vcf.py',
+                        description='Check the records of a VCF, writing what fails to <name>.issues.db')
+  clap.add_argument('vcf',
+                    help='VCF to check, optionally gzipped')
+  clap.add_argument('threads', nargs='?', default=1, type=int,
+                    help='worker processes, one contig each')
+  clap.add_argument('-r', '--rules', nargs='+', default=list(RULES), choices=list(RULES),
+                    help='rules to apply, all by default')
+  clap.add_argument('-n', '--first', default=None, type=int,
+                    help='stop after the first N issues')
+  clap.add_argument('--ploidy', default=2, type=int,
+                    help='expected genotype ploidy for the ploidy rule')
+  clap.add_argument('--header', default=None,
+                    help='header file to compare the VCF header to, e.g. old_header.txt')
+  clap.add_argument('-s', '--sample', default=None, type=int, metavar='BLOCKS',
+                    help='only check this many randomly placed blocks per contig and '
+                         'estimate issue rates from them')
+  clap.add_argument('--seed', default=0, type=int,
+                    help='random seed of --sample')
+  return clap
 
-dblock = None
-dbcrs = None
-dbcon = None
-name = ""
 
 def main():
-  global dblock
-  f = sys.argv[1]
-  threads = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+  clap = make_argparse()
+  args = clap.parse_args()
+  f = args.vcf
+  threads = args.threads
 
   gz = f.endswith('.gz')
   base = re.sub('\.vcf(\.gz)?', "", basename(f))
   dbn = base + '.issues.db'
 
+  bgzf = gz and is_bgzf(f)
+  if args.sample and gz and not bgzf:
+    clap.error('--sample needs an uncompressed or bgzipped VCF')
+  if args.sample and args.first:
+    clap.error('--sample and --first do not combine')
+
   create_database(dbn)
   vcfopen = partial(gzopen, mode='rt') if gz else open
-  contigs = []
   with vcfopen(f) as inp:
-    for line in inp:
-      if line.startswith('##contig'):
-        contigs.append(re.search('ID=([^,]+),', line)[1])
-      if line.startswith('##'): continue
-      data = line.strip().split()
-      samples = data[9:]
-      break
-
-  con = sqlite3.connect(dbn)
-  con.executemany(_ADD_SAMPLE_, [(i, s) for i,s in enumerate(samples)])
-  con.commit()
-  con.close()
-
-  if threads == 1:
-    process_vcf(f, dbn, gz=gz)
+    ctx = read_header(inp)
+  ctx.update(rules=args.rules, ploidy=args.ploidy, first=args.first)
+
+  # file level checks, as issues without a line
+  header = None
+  if args.header:
+    start = perf_counter()
+    with open(args.header) as inp:
+      other = read_header(inp)
+    header = ([(e, c, None, rule_id('header')) for e, c in compare_header(ctx, other)],
+              perf_counter() - start)
+
+  # with a tabix/CSI index each worker seeks straight to its contig
+  spans = read_index(f) if bgzf else None
+
+  if args.sample:
+    # one stratum per indexed contig, else the whole file
+    strata = spans or {'*': (0, getsize(f) << 16)}
+    work = [(f, ctx, c, span, args.sample, bgzf, args.seed)
+            for c, span in sorted(strata.items(), key=lambda cs: cs[1][0] - cs[1][1])]
+    if threads == 1:
+      results = [sample_vcf(*w) for w in work]
+    else:
+      with Pool(threads) as p:
+        results = p.starmap(sample_vcf, work)
+    estimates = estimate_rates([w[2] for w in work], [r[4] for r in results], ctx['rules'])
+    results = [r[:4] for r in results]
+  elif threads == 1:
+    results = [process_vcf(f, ctx, gz=gz, span=(0, None) if spans is not None else None)]
   else:
-    dblock = Lock()
     p = Pool(threads)
-    for c in contigs:
-      p.apply_async(process_vcf, (f, dbn, c, gz, True))
-
+    if spans is None:
+      print('No .tbi or .csi index beside', f, '- every worker reads the whole file')
+      jobs = [p.apply_async(process_vcf, (f, ctx, c, gz)) for c in ctx['contigs']]
+    else:
+      # largest contigs first, so a big one is not left running alone at the end
+      jobs = [p.apply_async(process_vcf, (f, ctx, c, gz, span))
+              for c, span in sorted(spans.items(), key=lambda cs: cs[1][0] - cs[1][1])]
     p.close()
+    results = [j.get() for j in jobs]
     p.join()
 
+  stats = merge_count_maps(dbn, ctx['samples'], results, header, args.first)
+  for r, (n, secs) in stats.items():
+    print(f'{r}\t{n} issues\t{secs:.2f}s')
+
+  if args.sample:
+    con = sqlite3.connect(dbn)
+    with con:
+      con.executemany(_ADD_ESTIMATE_, [(c, rule_id(r), *e) for c, r, *e in estimates])
+    con.close()
+    print('rule\tissues/record\t95% CI\testimated issues')
+    for c, r, _, _, _, rate, lo, hi, n in estimates:
+      if c is None:
+        print(f'{r}\t{rate:.3g}\t[{lo:.3g}, {hi:.3g}]\t{rate * n:.0f} of ~{n:.0f} records')
+
+
+# one row per contig however the workers split it, contigs numbered in file order;
+# with first, only the first issues in file order are kept, header issues first
+def merge_count_maps(dbn, samples, results, header=None, first=None):
+  counts = Counter()
+  firstline = {}
+  seconds = Counter()
+  for rcounts, rfirst, rsecs, _ in results:
+    counts.update(rcounts)
+    seconds.update(rsecs)
+    for c, j in rfirst.items():
+      firstline[c] = min(j, firstline.get(c, j))
+  cids = {c: i + 1 for i, c in enumerate(sorted(firstline, key=firstline.get))}
+
+  loci, issues = [], []
+  if header:
+    issues += header[0]
+    seconds['header'] += header[1]
+  for *_, (rloci, rissues) in results:
+    loci += rloci
+    issues += rissues
+  if first is not None and len(issues) > first:
+    issues.sort(key=lambda i: -1 if i[2] is None else i[2])
+    del issues[first:]
+    lines = {i[2] for i in issues}
+    loci = [l for l in loci if l[0] in lines]
+  found = Counter(i[3] for i in issues)
+  rules = [r for r in _RULE_IDS_ if r in seconds]
 
-
-def merge_count_maps():
-  pass
-
-
-def safe_execute(stmt, args, many=False):
-  print(name, 'executing')
-  try:
-    dblock.acquire()
-    print(name, 'obtained lock')
-    execute(stmt, args, many)
-  except:
-    print('Bonk')
-    print(sys.exc_info())
-  finally:
-    try:
-      dblock.release()
-      print(name, 'released lock')
-    except:
-      print('Bonked')
-
-
-def execute(stmt, args, many=False):
-  if many:
-    dbcrs.executemany(stmt, args)
-  else:
-    dbcrs.execute(stmt, args)
-  dbcon.commit()
+  con = sqlite3.connect(dbn)
+  with con:
+    con.executemany(_ADD_SAMPLE_, enumerate(samples))
+    con.executemany(_ADD_CONTIG_, [(cid, c, counts[c]) for c, cid in cids.items()])
+    con.executemany(_ADD_RULE_, [(rule_id(r), r, found[rule_id(r)], seconds[r]) for r in rules])
+    con.executemany(_ADD_LOCUS_, [(j, cids[c], pos, form) for j, c, pos, form in loci])
+    con.executemany(_ADD_ISSUE_, issues)
+  con.close()
+  return {r: (found[rule_id(r)], seconds[r]) for r in rules}
 
 
-def process_vcf(f, dbn, contig=None, gz=True, lock=False):
-  global name, dbcon, dbcrs
-  transact = safe_execute if lock else execute
+# with span, a (first, end) pair of virtual offsets, line is each record's virtual
+# offset, otherwise its line number
+def process_vcf(f, ctx, contig=None, gz=True, span=None):
   vcfopen = partial(gzopen, mode='rt') if gz else open
   if contig:
     print("Processing", contig)
-    name = contig
-  
-  dbcon = sqlite3.connect(dbn)
-  dbcrs = dbcon.cursor()
 
-  loci = 0
-  lxrm = None
-  cid = None
-  with vcfopen(f) as inp:
+  rules = [(r, RULES[r], rule_id(r)) for r in ctx['rules']]
+  seconds = dict.fromkeys(ctx['rules'], 0.0)
+  stop = ctx['first']
+  counts = Counter()
+  first = {}
+  loci = []
+  issues = []
+  with (open(f, 'rb') if span else vcfopen(f)) as inp:
+    lines = bgzf_records(inp, *span) if span else enumerate(inp)
 
     switch = False
-    for j, line in enumerate(inp):
+    for j, line in lines:
       if not line: continue
       if line.startswith('#'): continue
-      if contig and not line.startswith(contig): # there's probably a better way to do this using the index
+      if contig and line[:line.find('\t')] != contig:
         if switch: break
         continue
       switch = True
 
-      xrm, pos, form, issues = check_line(line)
-
-      if xrm != lxrm:
-        if lxrm:
-          transact(_SET_COUNT_, (loci, cid))
-          loci = 0
-        transact(_ADD_CONTIG_, (xrm,))
-        cid = dbcrs.lastrowid
-        lxrm = xrm
-
-      loci += 1
-
-      if not issues: continue
-      transact(_ADD_LOCUS_, (j, cid, pos, form))
-      transact(_ADD_ISSUE_, [(d, c, j) for c, d in issues], many=True)
-
-    if lxrm:
-      transact(_SET_COUNT_, (loci, cid))
-  
-  dbcon.close()
+      data = line.split()
+      counts[data[0]] += 1
+      first.setdefault(data[0], j)
+
+      if not apply_rules(j, data, rules, ctx, seconds, loci, issues): continue
+      if stop is not None and len(issues) >= stop: break
+
+  return counts, first, seconds, (loci, issues)
+
+
+def apply_rules(j, data, rules, ctx, seconds, loci, issues):
+  n = len(issues)
+  for r, check, rid in rules:
+    start = perf_counter()
+    issues.extend((e, c, j, rid) for e, c in check(data, ctx))
+    seconds[r] += perf_counter() - start
+
+  if len(issues) > n:
+    loci.append((j, data[0], data[1], data[8] if len(data) > 8 else None))
+  return len(issues) - n
+
+
+# reads one random BGZF block (or _WINDOW_ bytes) from each of `blocks` equal strata of span
+def sample_vcf(f, ctx, contig, span, blocks, bgzf=True, seed=0):
+  print("Sampling", contig)
+  rng = random.Random(f'{seed} {contig}')
+  rules = [(r, RULES[r], rule_id(r)) for r in ctx['rules']]
+  seconds = dict.fromkeys(ctx['rules'], 0.0)
+  counts = Counter()
+  first = {}
+  loci = []
+  issues = []
+  tallies = []
+
+  lo, hi = span[0] >> 16, (span[1] >> 16) if span[1] is not None else getsize(f)
+  with open(f, 'rb') as inp:
+    if not bgzf:
+      lo = skip_header(inp, lo)
+    nbytes = hi - lo
+    if bgzf and span[1] is not None and span[1] & 0xffff:
+      # the records in the block holding the end, which is never sampled
+      size, ulen = block_size(inp, hi)
+      nbytes += size * (span[1] & 0xffff) / ulen
+    step = max(1, (hi - lo) / blocks)
+    reached = -1
+    for b in range(blocks):
+      off = int(lo + b * step + rng.random() * step)
+      if bgzf:
+        start = span[0] if b == 0 else next_block(inp, off, hi)
+        if start is None or start >> 16 <= reached: continue
+        coff = start >> 16
+        size, ulen = block_size(inp, coff)
+        reached = coff
+        lines = bgzf_records(inp, start, (coff + size) << 16)
+      else:
+        start = lo if b == 0 else off
+        if start <= reached: continue
+        size = min(_WINDOW_, hi - start)
+        reached = start + size
+        lines = text_records(inp, start, reached)
+
+      # a stratum's rules see no records before the block
+      ctx.pop('last', None)
+      ctx.pop('seen', None)
+      n, found, j0 = 0, len(issues), None
+      for i, (j, line) in enumerate(lines):
+        if i == 0 and start != (span[0] if bgzf else lo): continue
+        if not line or line.startswith('#'): continue
+        if contig != '*' and line[:line.find('\t')] != contig: continue
+        data = line.split()
+        counts[data[0]] += 1
+        first.setdefault(data[0], j)
+        if j0 is None: j0 = j
+        n += 1
+        apply_rules(j, data, rules, ctx, seconds, loci, issues)
+
+      if bgzf and b == 0:
+        # the first block is shared with the contig before or the header,
+        # only its share from the first record on is the stratum's
+        covered = (ulen - (j0 & 0xffff)) / ulen if j0 is not None and ulen else 0.0
+        nbytes -= size * (1 - covered)
+        size *= covered
+      tallies.append((size, n, Counter(i[3] for i in issues[found:])))
+
+  return counts, first, seconds, (loci, issues), (nbytes, tallies)
+
+def skip_header(inp, off):
+  inp.seek(off)
+  for line in inp:
+    if not line.startswith(b'#'): break
+    off += len(line)
+  return off
+
+def text_records(inp, first, end):
+  inp.seek(first)
+  j = first
+  for line in inp:
+    if j >= end: return
+    yield j, line.decode()
+    j += len(line)
+
+
+# ratio estimates of issues per record, each block a cluster of records
+def estimate_rates(strata, tallies, rules):
+  rows = []
+  # blocks, records, issues, sum of N * rate, sum of N^2 * var
+  total = {r: [0, 0, 0, 0.0, 0.0] for r in rules}
+  records = 0.0
+  for c, (nbytes, blocks) in zip(strata, tallies):
+    nb = len(blocks)
+    m = sum(n for _, n, _ in blocks)
+    if not m: continue
+    # records per sampled byte times the stratum's bytes
+    est = m / sum(b for b, _, _ in blocks) * nbytes
+    records += est
+    for r in rules:
+      rid = rule_id(r)
+      y = sum(t[rid] for _, _, t in blocks)
+      rate = y / m
+      var = 0.0
+      if nb > 1:
+        mbar = m / nb
+        var = sum((t[rid] - rate * n) ** 2 for _, n, t in blocks) / (nb * (nb - 1) * mbar ** 2)
+      rows.append((c, r, nb, m, y, rate, *interval(rate, var), est))
+      for k, v in enumerate([nb, m, y, est * rate, est ** 2 * var]):
+        total[r][k] += v
+
+  if records:
+    for r, (nb, m, y, nrate, nvar) in total.items():
+      rate = nrate / records
+      rows.append((None, r, nb, m, y, rate, *interval(rate, nvar / records ** 2), records))
+  return rows
+
+def interval(rate, var):
+  se = math.sqrt(var)
+  return max(0.0, rate - _Z_ * se), rate + _Z_ * se
+
+
+def read_header(inp):
+  ctx = {'contigs': [], 'info': set(), 'format': set(), 'samples': [], 'columns': 8}
+  for line in inp:
+    if line.startswith('##contig'):
+      ctx['contigs'].append(re.search('ID=([^,>]+)', line)[1])
+    elif line.startswith(('##INFO', '##FORMAT')):
+      ctx['info' if line[2] == 'I' else 'format'].add(re.search('ID=([^,>]+)', line)[1])
+    if line.startswith('##'): continue
+    data = line.strip().split()
+    ctx['samples'] = data[9:]
+    ctx['columns'] = len(data)
+    break
+  return ctx
+
+
+# {contig: (first, end)} virtual offsets from the index beside f, None if unindexed
+def read_index(f):
+  for ext, csi in (('.csi', True), ('.tbi', False)):
+    if exists(f + ext):
+      with gzopen(f + ext) as inp:
+        return index_spans(parse_index(inp.read(), csi))
+  return None
+
+
+# name -> check(data, ctx), yielding (entry, sample column or None) for each
+# issue of a record; data is the record split on whitespace and ctx what
+# read_header found plus the options, and per-worker state a rule may keep
+RULES = {}
+
+def rule(name):
+  def register(check):
+    RULES[name] = check
+    return check
+  return register
+
+
+# sample columns with more or fewer fields than FORMAT
+@rule('fields')
+def check_fields(data, ctx):
+  if len(data) < 10: return
+  n = data[8].count(':')
+  for i, s in enumerate(data[9:]):
+    if s.count(':') != n:
+      yield s, i
+
+@rule('columns')
+def check_columns(data, ctx):
+  if len(data) != ctx['columns']:
+    yield f'{len(data)} columns, header has {ctx["columns"]}', None
+
+# records before the previous one, and contigs that come back after another
+@rule('sorted')
+def check_sorted(data, ctx):
+  c = data[0]
+  if not data[1].isdigit():
+    yield 'POS ' + data[1], None
+    return
+  pos = int(data[1])
+  last = ctx.get('last')
+  if last and last[0] == c:
+    if pos < last[1]:
+      yield f'POS {pos} after {last[1]}', None
+  else:
+    seen = ctx.setdefault('seen', set())
+    if c in seen:
+      yield f'{c} again after {last[0]}', None
+    seen.add(c)
+  ctx['last'] = c, pos
+
+_REF_ = re.compile('[ACGTN]+$')
+# bases, symbolic, spanning deletion, missing and breakends
+_ALT_ = re.compile(r'([ACGTN]+|<[^>]+>|\*|\.|\.[ACGTN]+|[ACGTN]+\.|[ACGTN]*[\[\]].*)$')
+
+# REF not upper case bases, ALT neither that nor symbolic
+@rule('case')
+def check_case(data, ctx):
+  if not _REF_.match(data[3]):
+    yield 'REF ' + data[3], None
+  for a in data[4].split(','):
+    if not _ALT_.match(a):
+      yield 'ALT ' + a, None
+
+# missing genotypes ('.') pass
+@rule('ploidy')
+def check_ploidy(data, ctx):
+  if len(data) < 10 or not data[8].startswith('GT'): return
+  nalt = 0 if data[4] == '.' else data[4].count(',') + 1
+  # a record has few distinct genotypes
+  seen = {}
+  for i, s in enumerate(data[9:]):
+    gt = s.partition(':')[0]
+    if gt not in seen:
+      seen[gt] = genotype_issue(gt, nalt, ctx['ploidy'])
+    if seen[gt]:
+      yield seen[gt], i
+
+def genotype_issue(gt, nalt, ploidy):
+  if gt == '.': return None
+  als = gt.replace('|', '/').split('/')
+  if len(als) != ploidy:
+    return f'ploidy {len(als)} {gt}'
+  for a in als:
+    if a != '.' and not (a.isdigit() and int(a) <= nalt):
+      return f'allele {a} {gt}'
+  return None
+
+# INFO and FORMAT keys without an ##INFO or ##FORMAT line
+@rule('keys')
+def check_keys(data, ctx):
+  if data[7] != '.':
+    for kv in data[7].split(';'):
+      k = kv.partition('=')[0]
+      if k not in ctx['info']:
+        yield 'INFO ' + k, None
+  # most files have a handful of FORMATs
+  good = ctx.setdefault('good_formats', set())
+  if len(data) < 9 or data[8] in good: return
+  bad = [k for k in data[8].split(':') if k not in ctx['format']]
+  for k in bad:
+    yield 'FORMAT ' + k, None
+  if not bad:
+    good.add(data[8])
+
+# ids of the rule table, 'header' for compare_header
+_RULE_IDS_ = list(RULES) + ['header']
+
+def rule_id(r):
+  return _RULE_IDS_.index(r) + 1
+
+# renamed sample columns, and keys declared in only one header
+def compare_header(ctx, other):
+  a, b = ctx['samples'], other['samples']
+  for i in range(max(len(a), len(b))):
+    x = a[i] if i < len(a) else None
+    y = b[i] if i < len(b) else None
+    if x != y:
+      yield f'sample {x} was {y}', i if x is not None else None
+  for kind in ['info', 'format']:
+    for k in sorted(ctx[kind] - other[kind]):
+      yield f'{kind.upper()} {k} added', None
+    for k in sorted(other[kind] - ctx[kind]):
+      yield f'{kind.upper()} {k} removed', None
 
 
 def check_line(line):
   data = line.strip().split()
-  xrm, pos = data[0:2]
-  form = data[8]
-  samples = data[9:]
-
-  fields = form.split(':')
-  n = len(fields)
-  
-  missing = []
-  for i, s in enumerate(samples):
-    sdata = s.split(':')
-    if len(sdata) == n: continue
-    missing.append((i, s))
-  
-  return xrm, pos, form, missing
+  return data[0], data[1], data[8], [(i, s) for s, i in check_fields(data, None)]
 
 
 def create_database(dbn):
@@ -195,12 +521,34 @@ def create_database(dbn):
                 column INTEGER PRIMARY KEY,
                 name VARCHAR(20)
               )""")
+
+  cur.execute("""
+              CREATE TABLE rule(
+                rid INTEGER PRIMARY KEY,
+                name VARCHAR(20) UNIQUE,
+                issues INT,
+                seconds REAL
+              )""")
   
+  cur.execute("""
+              CREATE TABLE estimate(
+                stratum VARCHAR(20),
+                rule INT REFERENCES rule,
+                blocks INT,
+                records INT,
+                issues INT,
+                rate REAL,
+                low REAL,
+                high REAL,
+                loci REAL
+              )""")
+
   cur.execute("""
               CREATE TABLE issue(
                 entry VARCHAR(100),
                 column INT REFERENCES sample,
-                line INT REFERENCES locus
+                line INT REFERENCES locus,
+                rule INT REFERENCES rule
               )""")
   
   con.commit()
@@ -209,4 +557,3 @@ def create_database(dbn):
 
 if __name__ == '__main__':
   main()
-  
\ No newline at end of file
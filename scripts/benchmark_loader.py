@@ -0,0 +1,186 @@
+from argparse import ArgumentParser
+import sys, os, subprocess, sqlite3
+from os.path import abspath, dirname, join, getsize, basename
+from tempfile import TemporaryDirectory
+from datetime import datetime
+
+from synth_vcf import add_synth_args, write_synth
+
+here = dirname(abspath(__file__))
+loader = join(here, 'variant_database.py')
+checker = join(here, '..', 'multi_ancestry_prs', 'vcf_inspection', 'check_vcf.py')
+
+# name, statement; :lo/:hi are a ~1% window of the first contig's positions
+_QUERIES_ = [
+  ('variant count', "SELECT count(*) FROM variant"),
+  ('region loci', "SELECT count(*) FROM locus WHERE cid = 1 AND pos BETWEEN :lo AND :hi"),
+  ('region variants', """SELECT count(*) FROM locus JOIN variant USING (line)
+                         WHERE cid = 1 AND pos BETWEEN :lo AND :hi"""),
+  ('sample variants', "SELECT count(*) FROM variant WHERE column = 0"),
+  ('class count', "SELECT count(*) FROM variant WHERE class = (SELECT code FROM class WHERE name = 'in')"),
+  ('allele scan', "SELECT count(*) FROM variant WHERE alt = (SELECT aid FROM allele WHERE seq = 'a')"),
+  ('sample classes', "SELECT class, count(*) FROM variant WHERE column = 0 GROUP BY class"),
+]
+
+
+def make_argparse():
+  clap = ArgumentParser(prog='benchmark_loader.py',
+                        description='Time variant_database.py and check_vcf.py across worker counts')
+  clap.add_argument('vcf', nargs='?', default=None,
+                    help='VCF to load, optionally gzipped; a synthetic one is generated if omitted')
+  clap.add_argument('-t', '--tools', default=['loader'], nargs='+', choices=['loader', 'checker'],
+                    help='tools to run')
+  clap.add_argument('--compression', default='both', choices=['plain', 'bgzip', 'both'],
+                    help='which synthetic VCFs to generate')
+  clap.add_argument('-w', '--workers', default=[1, 2, 4, 8], type=int, nargs='+',
+                    help='worker counts to compare')
+  clap.add_argument('-c', '--chunks', default=None, type=int,
+                    help='chunks per run, defaults to the loader\'s own (4 per worker)')
+  clap.add_argument('--batch', default=1000, type=int,
+                    help='passed through to the loader')
+  clap.add_argument('--txn', default=100000, type=int,
+                    help='passed through to the loader')
+  clap.add_argument('-q', '--queries', action='store_true',
+                    help='instead, time typical queries before and after building indexes')
+  clap.add_argument('-r', '--repeats', default=5, type=int,
+                    help='query repetitions, the best time is kept')
+  add_synth_args(clap)
+  return clap
+
+
+def main():
+  args = make_argparse().parse_args()
+  with TemporaryDirectory() as sd:
+    if args.vcf:
+      vcfs = [abspath(args.vcf)]
+    else:
+      vcfs = synthesize(sd, args)
+
+    if args.queries:
+      return bench_queries(vcfs[0], args)
+
+    rows = []
+    for vcf in vcfs:
+      for tool in args.tools:
+        for w in args.workers:
+          rows.append(run_tool(tool, vcf, w, args))
+          print(f'{tool} {basename(vcf)} {w} worker(s) done in {rows[-1][4]:.2f}s', file=sys.stderr)
+
+  print('tool\tinput\tworkers\tchunks\tseconds\tlines\tlines/s\tpeak_rss_MiB\tdb_MiB\tspeedup')
+  base = {}
+  for tool, vcf, w, c, secs, lines, rss, size in rows:
+    b = base.setdefault((tool, vcf), secs)
+    rss = f'{rss/2**20:.1f}' if rss else 'NA'
+    print(f'{tool}\t{basename(vcf)}\t{w}\t{c}\t{secs:.2f}\t{lines}\t{lines/secs:.0f}\t'
+          f'{rss}\t{size/2**20:.1f}\t{b/secs:.2f}')
+
+
+def synthesize(sd, args):
+  params = dict(samples=args.samples, loci=args.loci, contigs=args.contigs,
+                format_width=args.format_width, phased=args.phased,
+                multiallelic=args.multiallelic, indels=args.indels,
+                missing=args.missing, alt_af=args.alt_af, seed=args.seed)
+  exts = {'plain': ['.vcf'], 'bgzip': ['.vcf.gz'], 'both': ['.vcf', '.vcf.gz']}[args.compression]
+  vcfs = []
+  for ext in exts:
+    fn = join(sd, f'synth_{args.samples}s_{args.loci}l' + ext)
+    print(f'Generating {basename(fn)}', file=sys.stderr)
+    write_synth(fn, **params)
+    vcfs.append(fn)
+  return vcfs
+
+def run_timed(cmd, cwd):
+  """
+  Runs cmd, returns wall seconds and the peak RSS in bytes of its largest
+  process (including pool workers), where the platform can report it.
+  """
+  start = datetime.now()
+  p = subprocess.Popen(cmd, cwd=cwd)
+  if hasattr(os, 'wait4'):
+    _, status, ru = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    rss = ru.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+  else:
+    p.wait()
+    rss = None
+  secs = (datetime.now() - start).total_seconds()
+  if p.returncode != 0:
+    raise subprocess.CalledProcessError(p.returncode, cmd)
+  return secs, rss
+
+def chunk_arg(args):
+  # left out so the loader picks its own default of 4 chunks per worker
+  return [str(args.chunks)] if args.chunks else []
+
+def run_tool(tool, vcf, w, args):
+  with TemporaryDirectory() as wd:
+    if tool == 'loader':
+      chunks = max(w, args.chunks) if args.chunks else 4 * w
+      cmd = [sys.executable, loader, vcf, str(w), *chunk_arg(args),
+             '--batch', str(args.batch), '--txn', str(args.txn)]
+      ext, count = '.v.db', "SELECT count(*) FROM locus"
+    else:
+      chunks = None
+      cmd = [sys.executable, checker, vcf, str(w)]
+      ext, count = '.issues.db', "SELECT sum(loci) FROM contig"
+    secs, rss = run_timed(cmd, wd)
+
+    dbn = join(wd, [f for f in os.listdir(wd) if f.endswith(ext)][0])
+    con = sqlite3.connect(dbn)
+    lines, = con.execute(count).fetchone()
+    con.close()
+    size = getsize(dbn)
+  return tool, vcf, w, chunks, secs, lines or 0, rss, size
+
+
+def time_queries(con, params, repeats):
+  times = []
+  for _, stmt in _QUERIES_:
+    best = None
+    for _ in range(repeats):
+      start = datetime.now()
+      con.execute(stmt, params).fetchall()
+      secs = (datetime.now() - start).total_seconds()
+      best = secs if best is None else min(best, secs)
+    times.append(best)
+  return times
+
+def bench_queries(vcf, args):
+  sys.path.insert(0, here)
+  from variant_database import create_indexes
+
+  w = args.workers[0]
+  with TemporaryDirectory() as wd:
+    subprocess.run([sys.executable, loader, vcf, str(w), *chunk_arg(args),
+                    '--batch', str(args.batch), '--txn', str(args.txn), '--no-index'],
+                   cwd=wd, check=True)
+    dbn = join(wd, [f for f in os.listdir(wd) if f.endswith('.v.db')][0])
+
+    con = sqlite3.connect(dbn)
+    lo, hi = con.execute("SELECT min(pos), max(pos) FROM locus WHERE cid = 1").fetchone()
+    params = {'lo': lo + (hi - lo) // 2, 'hi': lo + (hi - lo) // 2 + (hi - lo) // 100}
+    bare = time_queries(con, params, args.repeats)
+    bare_size = getsize(dbn)
+    con.close()
+
+    start = datetime.now()
+    create_indexes(dbn)
+    index_secs = (datetime.now() - start).total_seconds()
+
+    con = sqlite3.connect(dbn)
+    indexed = time_queries(con, params, args.repeats)
+    con.close()
+    indexed_size = getsize(dbn)
+
+  print(f'index build {index_secs:.2f}s, database {bare_size/2**20:.1f} -> {indexed_size/2**20:.1f} MiB')
+  print('query\tunindexed_ms\tindexed_ms\tspeedup')
+  for (q, _), b, i in zip(_QUERIES_, bare, indexed):
+    print(f'{q}\t{b*1000:.2f}\t{i*1000:.2f}\t{b/max(i, 1e-9):.1f}')
+
+
+if __name__ == '__main__':
+  main()
+
+# python benchmark_loader.py "..\misc_data\1KGQ_common_pop_phased.vcf.gz" -w 1 2 4 8
+# python benchmark_loader.py "..\misc_data\1KGQ_common_pop_phased.vcf.gz" -w 6 --queries
+# python benchmark_loader.py -t loader checker -w 1 2 4 8 --samples 500 --loci 200000 --format-width 5
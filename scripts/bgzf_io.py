@@ -0,0 +1,210 @@
+import struct, zlib
+from itertools import accumulate
+
+_BGZF_HEAD_ = b'\x1f\x8b\x08\x04'
+# a BGZF block holds at most 64KiB, bgzip fills 0xff00 to leave room for the header
+_BGZF_DATA_ = 0xff00
+_BGZF_EOF_ = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def is_bgzf(f):
+  with open(f, 'rb') as inp:
+    head = inp.read(16)
+  return head[:4] == _BGZF_HEAD_ and head[12:14] == b'BC'
+
+def block_size(inp, coff):
+  """
+  (compressed, uncompressed) size of the BGZF block at byte coff.
+  """
+  inp.seek(coff + 16)
+  size = struct.unpack('<H', inp.read(2))[0] + 1
+  inp.seek(coff + size - 4)
+  return size, struct.unpack('<I', inp.read(4))[0]
+
+def next_block(inp, off, end):
+  """
+  Virtual offset of the first BGZF block starting at or after byte off and
+  before end, None if there is none.
+  """
+  while off < end:
+    inp.seek(off)
+    buf = inp.read(1 << 17)
+    if not buf: return None
+    i = buf.find(_BGZF_HEAD_)
+    while i >= 0 and i + 18 <= len(buf):
+      if buf[i+10:i+16] == b'\x06\x00BC\x02\x00':
+        return (off + i) << 16 if off + i < end else None
+      i = buf.find(_BGZF_HEAD_, i + 1)
+    off += len(buf) - 17
+  return None
+
+
+class BgzfReader:
+  """
+  Lines of a BGZF file from a virtual offset on.
+  """
+  def __init__(self, inp):
+    self.inp = inp
+    self.load(0)
+
+  def load(self, coff):
+    self.inp.seek(coff)
+    head = self.inp.read(18)
+    self.coff, self.pos = coff, 0
+    if len(head) < 18:
+      self.data, self.next = b'', None
+      return
+    bsize = struct.unpack_from('<H', head, 16)[0] + 1
+    self.data = zlib.decompressobj(-15).decompress(self.inp.read(bsize - 18))
+    self.next = coff + bsize
+
+  def seek(self, voff):
+    if voff >> 16 != self.coff:
+      self.load(voff >> 16)
+    self.pos = voff & 0xffff
+
+  def tell(self):
+    if self.pos >= len(self.data) and self.next is not None:
+      return self.next << 16
+    return (self.coff << 16) | self.pos
+
+  def readline(self):
+    parts = []
+    while True:
+      nl = self.data.find(b'\n', self.pos)
+      if nl >= 0:
+        parts.append(self.data[self.pos:nl+1])
+        self.pos = nl + 1
+        break
+      parts.append(self.data[self.pos:])
+      if self.next is None: break
+      self.load(self.next)
+    return b''.join(parts)
+
+def bgzf_records(inp, first, end=None):
+  """
+  Yields (virtual offset, line) for the lines of a BGZF file starting at
+  virtual offset first, up to (not including) a line starting at end.
+  """
+  reader = BgzfReader(inp)
+  reader.seek(first)
+  while True:
+    start = reader.tell()
+    if end is not None and start >= end: return
+    line = reader.readline()
+    if not line: return
+    yield start, line.decode()
+
+
+class BgzfWriter:
+  """
+  Minimal bgzip: deflates full 0xff00 byte blocks and ends with the EOF block.
+  Closes the binary file it writes to when it is closed.
+  """
+  def __init__(self, out):
+    self.out = out
+    self.buf = bytearray()
+
+  def write(self, data: bytes):
+    self.buf += data
+    while len(self.buf) >= _BGZF_DATA_:
+      self.block(bytes(self.buf[:_BGZF_DATA_]))
+      del self.buf[:_BGZF_DATA_]
+
+  def block(self, data):
+    c = zlib.compressobj(6, zlib.DEFLATED, -15)
+    comp = c.compress(data) + c.flush()
+    self.out.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00')
+    self.out.write(struct.pack('<H', len(comp) + 25))
+    self.out.write(comp)
+    self.out.write(struct.pack('<II', zlib.crc32(data), len(data)))
+
+  def close(self):
+    if self.buf:
+      self.block(bytes(self.buf))
+    self.out.write(_BGZF_EOF_)
+    self.out.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def parse_index(data, csi):
+  """
+  Parses a decompressed .csi (csi true) or .tbi into (min_shift, depth,
+  {contig: (bins, linear)}), bins being {bin: (first offset, chunks)} and
+  linear a .tbi's linear index made non-decreasing, None for a .csi.
+  """
+  if csi:
+    min_shift, depth, l_aux = struct.unpack_from('<3i', data, 4)
+    # the aux data of a VCF's CSI is the tabix header, whose last field is the names
+    l_nm, = struct.unpack_from('<i', data, 16 + 24)
+    names = data[44:44 + l_nm]
+    o = 16 + l_aux
+    n_ref, = struct.unpack_from('<i', data, o)
+    o += 4
+  else:
+    min_shift, depth = 14, 5
+    n_ref, = struct.unpack_from('<i', data, 4)
+    l_nm, = struct.unpack_from('<i', data, 32)
+    names = data[36:36 + l_nm]
+    o = 36 + l_nm
+
+  refs = {}
+  for contig in names.decode().split('\0')[:n_ref]:
+    n_bin, = struct.unpack_from('<i', data, o)
+    o += 4
+    bins = {}
+    for _ in range(n_bin):
+      if csi:
+        b, loff, n_chunk = struct.unpack_from('<IQi', data, o)
+        o += 16
+      else:
+        b, n_chunk = struct.unpack_from('<Ii', data, o)
+        loff = None
+        o += 8
+      chunks = struct.unpack_from(f'<{2*n_chunk}Q', data, o)
+      o += 16 * n_chunk
+      bins[b] = loff, chunks
+    linear = None
+    if not csi:
+      n_intv, = struct.unpack_from('<i', data, o)
+      linear = list(accumulate(struct.unpack_from(f'<{n_intv}Q', data, o + 4), max))
+      o += 4 + 8 * n_intv
+    refs[contig] = bins, linear
+  return min_shift, depth, refs
+
+def index_spans(index):
+  """
+  {contig: (first, end)}, the virtual offsets spanning each indexed
+  contig's records.
+  """
+  _, depth, refs = index
+  pseudo = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+  spans = {}
+  for contig, (bins, _) in refs.items():
+    offs = [c for b, (_, chunks) in bins.items() if b != pseudo for c in chunks]
+    if offs:
+      spans[contig] = min(offs[0::2]), max(offs[1::2])
+  return spans
+
+def seek_offset(index, contig, pos):
+  """
+  Virtual offset at or before the first record of a contig that can start
+  at 1-based pos, None if the index has no records there.
+  """
+  min_shift, depth, refs = index
+  bins, linear = refs[contig]
+  beg = pos - 1
+  if linear is not None:
+    i = beg >> min_shift
+    # leading windows without records stay 0
+    return (linear[i] or None) if i < len(linear) else None
+  # the deepest bin holding pos, or the nearest ancestor the index has
+  b = ((1 << depth * 3) - 1) // 7 + (beg >> min_shift)
+  while b not in bins and b > 0:
+    b = (b - 1) >> 3
+  return bins[b][0] if b in bins else None
@@ -0,0 +1,170 @@
+"""
+Packed genotype matrices kept beside a variant database.
+
+Each contig gets a flat file of 2-bit calls, one row per locus in file order
+and (nsamples+3)//4 bytes per row, plus a sorted array of the locus.line ids
+of its rows. Locus metadata stays in the sqlite database; join on line.
+"""
+import os, json, shutil
+from os.path import join, exists
+from glob import glob
+
+import numpy as np
+
+# 2-bit call codes, the number of non-reference alleles or missing
+HOM_REF, HET, HOM_ALT, MISSING = 0, 1, 2, 3
+
+# non-reference alleles held in each possible packed byte, missing counts none
+_ALLELES_ = np.array([sum(c for c in ((b >> s) & 3 for s in (0, 2, 4, 6)) if c != MISSING)
+                      for b in range(256)], dtype=np.uint8)
+
+
+def row_bytes(nsamples):
+  return (nsamples + 3) // 4
+
+def pack(codes: np.ndarray) -> np.ndarray:
+  """
+  (rows, samples) call codes -> (rows, row_bytes) packed uint8
+  """
+  codes = np.asarray(codes, dtype=np.uint8)
+  pad = -codes.shape[1] % 4
+  if pad:
+    codes = np.pad(codes, ((0, 0), (0, pad)))
+  q = codes.reshape(codes.shape[0], -1, 4)
+  return q[..., 0] | q[..., 1] << 2 | q[..., 2] << 4 | q[..., 3] << 6
+
+def unpack(packed: np.ndarray, nsamples) -> np.ndarray:
+  """
+  (..., row_bytes) packed uint8 -> (..., samples) call codes
+  """
+  packed = np.asarray(packed, dtype=np.uint8)
+  codes = np.stack([(packed >> s) & 3 for s in (0, 2, 4, 6)], axis=-1)
+  return codes.reshape(*packed.shape[:-1], -1)[..., :nsamples]
+
+
+### Loading
+def segment_base(store, chunk, cid):
+  return join(store, 'seg', f'{chunk}.{cid}')
+
+def write_segment(store, chunk, cid, lines, codes):
+  """
+  Appends rows to the segment files of one contig of one chunk.
+  """
+  fb = segment_base(store, chunk, cid)
+  with open(fb + '.gt', 'ab') as out:
+    out.write(pack(codes).tobytes())
+  with open(fb + '.line', 'ab') as out:
+    out.write(np.asarray(lines, dtype=np.int64).tobytes())
+
+def drop_segments(store, chunk):
+  """
+  Deletes a chunk's segment files of every contig.
+  """
+  for fn in glob(segment_base(store, chunk, '*')):
+    os.remove(fn)
+
+def is_unfinished(store):
+  return exists(join(store, 'seg'))
+
+def create_store(store):
+  if exists(store):
+    shutil.rmtree(store)
+  os.makedirs(join(store, 'seg'))
+
+def finalize_store(store, nchunks, contigs: dict, nsamples):
+  """
+  Concatenates chunk segments into one matrix per contig, in chunk (and so
+  file) order, and records row and allele counts in meta.json.
+  """
+  rb = row_bytes(nsamples)
+  meta = {'nsamples': nsamples, 'row_bytes': rb, 'contigs': {}}
+  for name, cid in contigs.items():
+    rows, alleles = 0, 0
+    lines = []
+    with open(join(store, f'{cid}.gt'), 'wb') as out:
+      for chunk in range(nchunks):
+        fb = segment_base(store, chunk, cid)
+        if not exists(fb + '.gt'): continue
+        seg = np.fromfile(fb + '.gt', dtype=np.uint8)
+        alleles += int(_ALLELES_[seg].sum(dtype=np.int64))
+        rows += len(seg) // rb
+        seg.tofile(out)
+        lines.append(np.fromfile(fb + '.line', dtype=np.int64))
+    np.save(join(store, f'{cid}.line.npy'),
+            np.concatenate(lines) if lines else np.empty(0, dtype=np.int64))
+    meta['contigs'][name] = {'cid': cid, 'rows': rows, 'alleles': alleles}
+
+  with open(join(store, 'meta.json'), 'w') as out:
+    json.dump(meta, out, indent=1)
+  shutil.rmtree(join(store, 'seg'))
+
+
+### Querying
+class GenotypeStore:
+  """
+  Read-only, memory-mapped view of a finalized store.
+
+    gs = GenotypeStore('1KGQ_common_pop_phased.gt')
+    gs.locus('chr1', line)    # calls of every sample at one locus
+    gs.sample(12, 'chr1')     # calls of sample column 12 at every chr1 locus
+    gs.alleles()              # == select count(*) from variant
+  """
+  def __init__(self, store):
+    self.store = store
+    with open(join(store, 'meta.json')) as inp:
+      meta = json.load(inp)
+    self.nsamples = meta['nsamples']
+    self.row_bytes = meta['row_bytes']
+    self.contigs = meta['contigs']
+    self._gt = {}
+    self._lines = {}
+
+  def matrix(self, contig) -> np.ndarray:
+    """
+    Packed (rows, row_bytes) matrix of a contig, memory-mapped.
+    """
+    if contig not in self._gt:
+      c = self.contigs[contig]
+      if c['rows'] == 0:
+        self._gt[contig] = np.empty((0, self.row_bytes), dtype=np.uint8)
+      else:
+        self._gt[contig] = np.memmap(join(self.store, f"{c['cid']}.gt"), dtype=np.uint8,
+                                     mode='r', shape=(c['rows'], self.row_bytes))
+    return self._gt[contig]
+
+  def lines(self, contig) -> np.ndarray:
+    """
+    locus.line of each row of a contig, ascending.
+    """
+    if contig not in self._lines:
+      cid = self.contigs[contig]['cid']
+      self._lines[contig] = np.load(join(self.store, f'{cid}.line.npy'), mmap_mode='r')
+    return self._lines[contig]
+
+  def row(self, contig, line):
+    lines = self.lines(contig)
+    r = int(np.searchsorted(lines, line))
+    if r == len(lines) or lines[r] != line:
+      raise KeyError(f'No locus at line {line} on {contig}')
+    return r
+
+  def locus(self, contig, line) -> np.ndarray:
+    return unpack(self.matrix(contig)[self.row(contig, line)], self.nsamples)
+
+  def loci(self, contig, start=0, stop=None) -> np.ndarray:
+    """
+    (rows, samples) calls for a row range of a contig.
+    """
+    return unpack(self.matrix(contig)[start:stop], self.nsamples)
+
+  def sample(self, column, contig) -> np.ndarray:
+    byte, shift = divmod(column, 4)
+    return (self.matrix(contig)[:, byte] >> 2*shift) & 3
+
+  def alleles(self, contig=None):
+    """
+    Non-reference allele calls, the number of rows in the variant table.
+    """
+    if contig is not None:
+      return self.contigs[contig]['alleles']
+    return sum(c['alleles'] for c in self.contigs.values())
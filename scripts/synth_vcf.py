@@ -0,0 +1,127 @@
+from argparse import ArgumentParser
+import sys, random
+from itertools import accumulate
+
+from bgzf_io import BgzfWriter
+
+
+_BASES_ = 'ACGT'
+_FORMAT_ = ['GT', 'DP', 'GQ', 'AD', 'PL', 'MIN_DP', 'SB', 'PS']
+
+
+def add_synth_args(clap):
+  synth = clap.add_argument_group('Synthetic VCF')
+  synth.add_argument('--samples', default=100, type=int,
+                     help='number of samples')
+  synth.add_argument('--loci', default=100000, type=int,
+                     help='number of records')
+  synth.add_argument('--contigs', default=3, type=int,
+                     help='number of contigs, records are spread evenly')
+  synth.add_argument('--format-width', default=2, type=int,
+                     help='FORMAT fields per sample, GT first')
+  synth.add_argument('--phased', default=1.0, type=float,
+                     help='fraction of phased genotypes')
+  synth.add_argument('--multiallelic', default=0.05, type=float,
+                     help='fraction of records with 2 or 3 alt alleles')
+  synth.add_argument('--indels', default=0.1, type=float,
+                     help='fraction of alt alleles that are insertions or deletions')
+  synth.add_argument('--missing', default=0.01, type=float,
+                     help='fraction of missing (./.) genotypes')
+  synth.add_argument('--alt-af', default=0.1, type=float,
+                     help='alt allele frequency of each genotype draw')
+  synth.add_argument('--seed', default=0, type=int,
+                     help='random seed')
+  return synth
+
+def make_argparse():
+  clap = ArgumentParser(prog='synth_vcf.py',
+                        description='Write a reproducible synthetic VCF for benchmarking')
+  clap.add_argument('out',
+                    help='output VCF, bgzipped if it ends with .gz')
+  add_synth_args(clap)
+  return clap
+
+
+def format_fields(width):
+  return _FORMAT_[:width] + [f'X{i}' for i in range(width - len(_FORMAT_))]
+
+def sample_pool(rng, nalts, width, phased, missing, alt_af, size=4096):
+  """
+  Pre-rendered sample columns for records with nalts alt alleles; records
+  draw from these so generation costs one choices() per record.
+  """
+  pool = []
+  for _ in range(size):
+    if rng.random() < missing:
+      gt = './.'
+    else:
+      als = [rng.randint(1, nalts) if rng.random() < alt_af else 0 for _ in range(2)]
+      gt = f"{als[0]}{'|' if rng.random() < phased else '/'}{als[1]}"
+    rest = [str(rng.randint(0, 99)) for _ in range(width - 1)]
+    pool.append(':'.join([gt] + rest))
+  return pool
+
+def header(contigs, samples, fields):
+  lines = ['##fileformat=VCFv4.2']
+  lines += [f'##contig=<ID={c},length={n}>' for c, n in contigs]
+  lines += ['##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count">',
+            '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency">',
+            '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">']
+  lines += [f'##FORMAT=<ID={f},Number=.,Type=String,Description="{f}">' for f in fields]
+  lines += ['\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples)]
+  return ''.join(l + '\n' for l in lines)
+
+def alt_allele(rng, ref, indels):
+  if rng.random() < indels:
+    if rng.random() < 0.5:
+      return ref + ''.join(rng.choices(_BASES_, k=rng.randint(1, 4)))
+    return '<DEL>'
+  return rng.choice([b for b in _BASES_ if b != ref])
+
+def write_synth(fn, samples=100, loci=100000, contigs=3, format_width=2, phased=1.0,
+                multiallelic=0.05, indels=0.1, missing=0.01, alt_af=0.1, seed=0):
+  """
+  Writes a sorted synthetic VCF, bgzipped if fn ends with .gz.
+  Returns the number of records.
+  """
+  rng = random.Random(seed)
+  fields = format_fields(format_width)
+  names = [f'SYN{i:06d}' for i in range(samples)]
+  per = [loci // contigs + (i < loci % contigs) for i in range(contigs)]
+  ctgs = [(f'chr{i+1}', 100 * n + 1000) for i, n in enumerate(per)]
+  pools = {n: sample_pool(rng, n, format_width, phased, missing, alt_af) for n in (1, 2, 3)}
+  form = ':'.join(fields)
+
+  out = BgzfWriter(open(fn, 'wb')) if fn.endswith('.gz') else open(fn, 'wb')
+  with out:
+    out.write(header(ctgs, names, fields).encode())
+    for (c, _), n in zip(ctgs, per):
+      for pos in accumulate(rng.randint(1, 199) for _ in range(n)):
+        ref = rng.choice(_BASES_)
+        nalts = rng.randint(2, 3) if rng.random() < multiallelic else 1
+        alts = []
+        while len(alts) < nalts:
+          a = alt_allele(rng, ref, indels)
+          if a == '<DEL>':
+            # a deletion lengthens ref, so only the first alt may be one
+            if alts: continue
+            ref, a = ref + rng.choice(_BASES_), ref
+          if a not in alts and a != ref: alts.append(a)
+        info = f'AC=1;AF=0.01;DP={rng.randint(10, 9999)}'
+        cols = [c, str(pos), '.', ref, ','.join(alts), '50', 'PASS', info, form]
+        cols += rng.choices(pools[nalts], k=samples)
+        out.write(('\t'.join(cols) + '\n').encode())
+  return loci
+
+
+def main():
+  args = vars(make_argparse().parse_args())
+  out = args.pop('out')
+  n = write_synth(out, **args)
+  print(f'Wrote {n} records to {out}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
+
+# python synth_vcf.py synth.vcf.gz --samples 2500 --loci 1000000 --format-width 5
@@ -1,57 +1,166 @@
 from gzip import open as gzopen
-from multiprocessing import Pool, Lock, Queue
-import sys, os, re, sqlite3
-from os.path import basename, exists
+from multiprocessing import Process, Queue, Event
+from multiprocessing.connection import wait
+from threading import Thread
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait as futures_wait
+from concurrent.futures.process import BrokenProcessPool
+from argparse import ArgumentParser, ArgumentTypeError
+import sys, os, re, sqlite3, zlib, queue, traceback
+from os.path import basename, exists, getsize, abspath
 from functools import partial
 from datetime import datetime, timedelta
+from time import perf_counter
 import tzdata
 
 from collections import defaultdict as ddict, Counter
+from itertools import groupby
+from operator import itemgetter
+import heapq
 import random # used for randomly naming child processes in log output.
 
+import numpy as np
+
+import genotype_store as gts
+try:
+  import variant_parquet as vpq
+except ImportError:
+  vpq = None
+
 # name
 _ADD_CONTIG_ = """
-INSERT INTO contig (name, loci) VALUES (?, 0)
+INSERT OR IGNORE INTO contig (name, loci) VALUES (?, 0)
 """
 _ADD_COUNT_ = """
 UPDATE contig
 SET loci = contig.loci + ?
 WHERE cid = ?
 """
-_GET_CONTIG_ID_ = """
-SELECT cid
-FROM contig
-WHERE name = ?
-"""
 
-# alt, class, sample column, locus line
+# alt allele id, class code, sample column, locus line
 _ADD_VARIANT_ = """
 INSERT INTO variant VALUES (?, ?, ?, ?)
 """
-# contig id, position, ref, info
+# line, contig id, position, ref allele id, info, then one value per info_field
+# line is the byte offset of the record in the vcf, so any worker can assign it
 _ADD_LOCUS_ = """
-INSERT INTO locus (cid, pos, ref, info)
-VALUES (?, ?, ?, ?)
+INSERT INTO locus
+VALUES (?, ?, ?, ?, ?{})
+"""
+# allele id, sequence
+_ADD_ALLELE_ = """
+INSERT INTO allele VALUES (?, ?)
+"""
+# key, type
+_ADD_INFO_FIELD_ = """
+INSERT INTO info_field VALUES (?, ?)
 """
 # column, name
 _ADD_SAMPLE_ = """
 INSERT INTO sample VALUES (?, ?)
 """
 
-dblock = None
+# path
+_GET_SOURCE_ = """
+SELECT sid, size, mtime, base
+FROM source
+WHERE path = ?
+"""
+# path, size, mtime, bgzf, base, span
+_ADD_SOURCE_ = """
+INSERT INTO source (path, size, mtime, bgzf, base, span)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+# source id, chunk, start, end
+_ADD_CHUNK_ = """
+INSERT INTO chunk VALUES (?, ?, ?, ?, 0)
+"""
+_GET_CHUNKS_ = """
+SELECT chunk, start, end, done
+FROM chunk
+WHERE sid = ?
+ORDER BY chunk
+"""
+# source id, chunk
+_CHUNK_DONE_ = """
+UPDATE chunk
+SET done = 1
+WHERE sid = ? AND chunk = ?
+"""
+
+# sample column, contig id, class, calls
+_ADD_CLASS_COUNT_ = """
+INSERT INTO sample_class VALUES (?, ?, ?, ?)
+ON CONFLICT (column, cid, class) DO UPDATE SET calls = calls + excluded.calls
+"""
+# sample column, contig id, het, hom_alt, missing
+_ADD_ZYGOSITY_ = """
+INSERT INTO sample_zygosity VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (column, cid) DO UPDATE
+SET het = het + excluded.het, hom_alt = hom_alt + excluded.hom_alt,
+    missing = missing + excluded.missing
+"""
+
+_ADD_METRIC_ = """
+INSERT INTO metric
+VALUES (:sid, :chunk, :worker, :bytes, :lines, :variants,
+        :read_s, :parse_s, :store_s, :wait_s, :write_s, :commit_s, :wall_s)
+"""
+_METRIC_FIELDS_ = ['bytes', 'lines', 'variants', 'read_s', 'parse_s', 'store_s',
+                   'wait_s', 'write_s', 'commit_s', 'wall_s']
+
+# variant.class codes, in the order of the class table
+_CLASSES_ = ['ts', 'tv', 'in', 'de', 'mp', 'nr']
+class_code = {c: i for i, c in enumerate(_CLASSES_)}
+
+# --info types: sql column type, value parser; numbers keep their first value
+# (Number=A/R keys hold the first alt's)
+_INFO_TYPES_ = {
+  'int': ('INT', lambda v: None if not v or v[0] == '.' else int(v.partition(',')[0])),
+  'float': ('REAL', lambda v: None if not v or v[0] == '.' else float(v.partition(',')[0])),
+  'str': ('TEXT', lambda v: v),
+  'flag': ('INT', lambda v: int(v is not None)),
+}
+# ##INFO Type -> --info type
+_HEADER_TYPES_ = {'Integer': 'int', 'Float': 'float', 'Flag': 'flag',
+                  'String': 'str', 'Character': 'str'}
+
+# built once the load is done, inserting into indexed tables is much slower
+_INDEXES_ = [
+  "CREATE INDEX IF NOT EXISTS locus_pos ON locus (cid, pos)",
+  "CREATE INDEX IF NOT EXISTS variant_line ON variant (line)",
+  "CREATE INDEX IF NOT EXISTS variant_column ON variant (column, class)",
+  "CREATE INDEX IF NOT EXISTS variant_class ON variant (class)",
+]
+
+# interval index of the bases each locus covers, for overlap queries
+_SPAN_INDEX_ = [
+  "DROP TABLE IF EXISTS locus_span",
+  "CREATE VIRTUAL TABLE locus_span USING rtree_i32(line, cid0, cid1, lo, hi)",
+  """INSERT INTO locus_span
+     SELECT line, cid, cid, pos, pos + length(seq) - 1 FROM locus JOIN allele ON aid = ref""",
+]
 
 name = None
 vcf = None
 vcfopen = None
-data_top = None
-data_len = None
-nchunks = None
+bgzf = None
+bounds = None
+line_base = None
 logfh = None
 
-dbn = None
-dbcon = None
-dbcrs = None
-transact = None
+writeq = None
+abort = None
+batch_size = None
+cids = None
+colmap = None
+gtstore = None
+parquet = None
+info_fields = None
+info_probes = None
+keep_info = None
+chunk_out = None
+nsamples = None
+parse_line = None
 
 names1 = ['Abby', 'Beni', 'Cari', 'Davy', 'Ezri', 'Fuji', 'Gary',
           'Hidi', 'Iggy', 'Jeri', 'Kody', 'Lemi', 'Mary',
@@ -62,22 +171,324 @@ names2 = ['Arvo', 'Brio', 'Cujo', 'Dido', 'Echo', 'Fafo', 'Geko',
           'Nero', 'Oreo', 'Polo', 'Quno', 'Reno', 'Silo', 'Taro',
           'Urso', 'Volo', 'Wako', 'Xylo', 'Yoyo', 'Zero']
 
+def make_argparse():
+  clap = ArgumentParser(prog='variant_database.py',
+                        description='Load a multi-sample VCF into a sqlite variant database')
+  clap.add_argument('vcf',
+                    help='input VCF, optionally gzipped')
+  clap.add_argument('ncpu', nargs='?', default=1, type=int,
+                    help='number of parser processes')
+  clap.add_argument('chunks', nargs='?', default=None, type=int,
+                    help='number of chunks to split the VCF into, at least ncpu; defaults to 4 per process so workers that finish early take the remaining chunks')
+  clap.add_argument('--batch', default=1000, type=int,
+                    help='loci per batch handed from a parser to the writer')
+  clap.add_argument('--txn', default=100000, type=int,
+                    help='loci per writer transaction')
+  clap.add_argument('--retries', default=2, type=int,
+                    help='times a failed chunk is discarded and parsed again')
+  clap.add_argument('--bulk', action='store_true',
+                    help='bulk-load mode: no journal, no fsync, no foreign key checks; an interrupted load leaves a corrupt database')
+  clap.add_argument('--no-index', action='store_true',
+                    help='skip building indexes and running ANALYZE after the load')
+  clap.add_argument('--reference-parser', action='store_true',
+                    help='parse lines with the original dict-per-sample parser, for comparing outputs')
+  clap.add_argument('--genotypes', action='store_true',
+                    help='also write a packed 2-bit genotype store (<base>.gt) beside the database')
+  clap.add_argument('--parquet', action='store_true',
+                    help='write loci and variants as Parquet datasets partitioned by contig (<base>.parquet) instead of into the database; needs pyarrow')
+  clap.add_argument('--info', nargs='+', default=[], type=info_arg, metavar='KEY[:TYPE]',
+                    help=f'store these INFO keys in typed, indexed locus columns (info_KEY) instead of the raw INFO string; TYPE is one of {", ".join(_INFO_TYPES_)}, by default the ##INFO header\'s')
+  clap.add_argument('--keep-info', action='store_true',
+                    help='with --info, also keep the raw INFO string')
+  clap.add_argument('--list-info', action='store_true',
+                    help='print the ##INFO fields of the header and exit')
+  clap.add_argument('-S', '--vcf-list', action='store_true',
+                    help='vcf is a text file listing sorted VCFs, one per line, to merge into one database in a single streaming pass')
+  clap.add_argument('--resume', action='store_true',
+                    help='keep an existing database and load only the chunks an earlier run did not finish')
+  clap.add_argument('--append', action='store_true',
+                    help='add this VCF\'s loci and samples to an existing database')
+  clap.add_argument('-d', '--database', default=None,
+                    help='database name (without .v.db), defaults to the VCF name; needed to --append to another VCF\'s database')
+  return clap
+
+def info_arg(spec):
+  key, _, kind = spec.partition(':')
+  if kind and kind not in _INFO_TYPES_:
+    raise ArgumentTypeError(f'{spec}: expected KEY[:TYPE] with TYPE one of {", ".join(_INFO_TYPES_)}')
+  return key, kind or None
+
+# types --info keys from the ##INFO header, exiting on an undeclared untyped key
+def resolve_info(requested, header):
+  spec = []
+  for key, kind in requested:
+    if kind is None:
+      if key not in header:
+        log(f'INFO key {key} is not in the header, give its type as {key}:TYPE')
+        sys.exit(1)
+      kind = _HEADER_TYPES_.get(header[key]['Type'], 'str')
+    if key in header and header[key]['Number'] not in ('0', '1') and kind in ('int', 'float'):
+      log(f'INFO key {key} has Number={header[key]["Number"]}, keeping the first value')
+    spec.append((key, kind))
+  return spec
+
 def main():
   global name
   name = 'Prologue'
   open_logfh()
 
-  vcf = sys.argv[1]
-  ncpu = int(sys.argv[2]) if len(sys.argv) > 2 else 1
-  chunks = max(ncpu, int(sys.argv[3])) if len(sys.argv) > 3 else ncpu
+  args = make_argparse().parse_args()
+  vcf = args.vcf
+  ncpu = args.ncpu
+  chunks = max(ncpu, args.chunks) if args.chunks else 4 * ncpu
+
+  base = re.sub(r'\.(vcf(\.gz)?|txt|list)$', "", basename(vcf))
+  if args.vcf_list:
+    with open(vcf) as inp:
+      vcfs = [v.strip() for v in inp if v.strip()]
+    log(f'Parsing {len(vcfs)} Headers...')
+    headers = [read_header(v, extent=False) for v in vcfs]
+    info_header = {k: f for v in reversed(vcfs) for k, f in read_info_header(v).items()}
+    contigs = list(dict.fromkeys(c for h in headers for c in h[0]))
+    samples = list(dict.fromkeys(s for h in headers for s in h[1]))
+    gz = bgz = False
+    # merged loci are numbered in merge order; no source has more loci than bytes
+    data_top, data_end = 0, sum(getsize(v) for v in vcfs)
+    chunks = 1
+  else:
+    gz = vcf.endswith('.gz')
+    bgz = gz and is_bgzf(vcf)
+    log('Parsing Header...')
+    info_header = read_info_header(vcf)
+    if args.list_info:
+      for k, f in info_header.items():
+        print(f"{k}\t{f['Number']}\t{f['Type']}\t{f.get('Description', '')}")
+      return
+    contigs, samples, data_top, data_end = read_header(vcf)
+    log(f'Found top of data at byte {data_top}')
+    log(f'Found end of data at byte {data_end}')
+
+  requested = resolve_info(args.info, info_header)
+  dbbase = args.database or base
+  dbn = dbbase + '.v.db'
+  keep = (args.resume or args.append) and exists(dbn)
+  if not keep:
+    log('Initializing database...')
+    create_database(dbn, requested)
+  con = sqlite3.connect(dbn)
+  info_spec = con.execute("SELECT key, type FROM info_field ORDER BY rowid").fetchall()
+  if requested and info_spec != requested:
+    log(f'{dbn} stores INFO keys {info_spec}, they cannot be changed.')
+    sys.exit(1)
+  sid, lbase, chunk_bs, todo = find_source(con, vcf)
+  resumed = sid is not None
+
+  if not resumed:
+    if keep and not args.append:
+      log(f'{vcf} was never loaded into {dbn}, use --append to add it.')
+      sys.exit(1)
+    if keep and args.genotypes:
+      log('A genotype store can only be built by a fresh load.')
+      sys.exit(1)
+    if keep and args.parquet:
+      log('A Parquet export can only be built by a fresh load.')
+      sys.exit(1)
+
+    if bgz:
+      log('Locating BGZF block boundaries...')
+      chunk_bs = plan_bgzf_chunks(vcf, data_top, chunks)
+    else:
+      if gz and chunks > 1:
+        log('Input is gzipped but not BGZF, it cannot be split; using one chunk.')
+        chunks = 1
+      data_len = data_end - data_top
+      chunk_bs = [int(data_top + data_len * (i/chunks)) for i in range(chunks+1)]
+    log(f'Planned {len(chunk_bs)-1} chunk(s)')
+
+    sid, lbase = add_source(con, vcf, bgz, data_end, chunk_bs, contigs, samples)
+    todo = list(range(len(chunk_bs)-1))
+  else:
+    log(f'Resuming {vcf}, {len(todo)} of {len(chunk_bs)-1} chunk(s) left')
+    drop_chunks(con, sid, todo)
+
+  contig_ids = dict(con.execute("SELECT name, cid FROM contig"))
+  columns = dict(con.execute("SELECT name, column FROM sample"))
+  colmap = [columns[s] for s in samples]
+  con.close()
+
+  store = dbbase + '.gt'
+  if args.genotypes and not keep:
+    gts.create_store(store)
+  elif resumed and gts.is_unfinished(store):
+    for funk in todo:
+      gts.drop_segments(store, funk)
+  else:
+    store = None
+
+  pqroot = dbbase + '.parquet'
+  if (args.parquet or resumed and exists(pqroot)) and vpq is None:
+    log('Parquet export needs pyarrow, pip install pyarrow')
+    sys.exit(1)
+  if args.parquet and not keep:
+    vpq.create_export(pqroot)
+  elif resumed and exists(pqroot):
+    for funk in todo:
+      vpq.drop_chunk(pqroot, funk)
+  else:
+    pqroot = None
+
+  log('Starting writer...')
+  writer = start_writer(dbn, ncpu, args.txn, sid, args.bulk)
+
+  log('Initializing Worker(s)...')
+  conf = (name_queue(ncpu), vcf, gz, bgz, chunk_bs, lbase,
+          writeq, abort, args.batch, contig_ids, colmap, store, pqroot, len(samples),
+          args.reference_parser, info_spec, args.keep_info or not info_spec)
 
+  if ncpu == 1 or args.vcf_list:
+    log('Executing in single process.')
+    logfh.close()
+
+    init_worker(*conf)
+    if args.vcf_list:
+      colmaps = [[columns[s] for s in h[1]] for h in headers]
+      run_serial(lambda _: process_merge_logged(vcfs, colmaps), [0], args.retries)
+    else:
+      run_serial(process_vcf_logged, todo, args.retries)
+    logfh.close()
+    name = 'Epilogue'
+    open_logfh()
+  else:
+    log(f'Executing in process pool({ncpu}).')
+    tries = Counter()
+    while todo := run_pool(ncpu, conf, todo, args.retries, tries):
+      # a killed worker can leave the queue torn, so the writer goes too and
+      # the chunks it had not marked done are dropped, as on --resume
+      writer.terminate()
+      writer.join()
+      if args.bulk:
+        log('A worker died during a --bulk load, the database may be corrupt; reload it without --bulk.')
+        logfh.close()
+        sys.exit(1)
+      con = sqlite3.connect(dbn)
+      drop_chunks(con, sid, todo)
+      done = {c for c, in con.execute("SELECT chunk FROM chunk WHERE sid = ? AND done", (sid,))}
+      con.close()
+      todo = [funk for funk in todo if funk not in done]
+      for funk in todo:
+        if store: gts.drop_segments(store, funk)
+        if pqroot: vpq.drop_chunk(pqroot, funk)
+      log(f'A worker died, restarting the writer and pool for {len(todo)} chunk(s)')
+      writer = start_writer(dbn, ncpu, args.txn, sid, args.bulk)
+      conf = (name_queue(ncpu), *conf[1:6], writeq, abort, *conf[8:])
+
+  log('Waiting on writer...')
+  try:
+    send(None)
+  except RuntimeError:
+    pass
+  writer.join()
+  if writer.exitcode:
+    log('The writer failed, see logs/Writer.log; rerun with --resume once it is fixed.')
+    logfh.close()
+    sys.exit(1)
+  summarize_metrics(dbn, sid)
+
+  con = sqlite3.connect(dbn)
+  left, = con.execute("SELECT count(*) FROM chunk WHERE sid = ? AND NOT done", (sid,)).fetchone()
+  con.close()
+  if left:
+    log(f'{left} chunk(s) did not finish, rerun with --resume to load them.')
+    logfh.close()
+    sys.exit(1)
+
+  if store:
+    log('Finalizing genotype store...')
+    gts.finalize_store(store, len(chunk_bs)-1, contig_ids, len(samples))
+  if pqroot:
+    vpq.write_tables(pqroot, dbn)
+
+  if lbase:
+    log('Merging appended loci into existing ones...')
+    start_time = datetime.now()
+    merged = merge_source(dbn, sid, lbase)
+    log(f'{timeform(datetime.now() - start_time)} merged {merged} loci')
+
+  if not args.no_index:
+    log('Building indexes...')
+    start_time = datetime.now()
+    create_indexes(dbn)
+    log(f'{timeform(datetime.now() - start_time)} indexed and analyzed')
+  log('Done.')
+  logfh.close()
+
+
+def start_writer(dbn, ncpu, txn, sid, bulk):
+  global writeq, abort
+  writeq, abort = Queue(maxsize=4*ncpu), Event()
+  writer = Process(target=write_batches_logged, args=(dbn, writeq, txn, sid, bulk))
+  writer.start()
+  Thread(target=watch_writer, args=(writer, abort, writeq), daemon=True).start()
+  return writer
+
+def name_queue(ncpu):
+  nameq = Queue()
+  for s in random.sample(range(26**2), ncpu):
+    nameq.put_nowait(s)
+  return nameq
+
+# retries chunks whose worker failed, and returns those left when a dead worker broke the pool
+def run_pool(ncpu, conf, todo, retries, tries):
+  broken = []
+  with ProcessPoolExecutor(ncpu, initializer=init_worker, initargs=conf) as pool:
+    def submit(funk):
+      try:
+        running[pool.submit(process_vcf_logged, funk)] = funk
+      except BrokenProcessPool:
+        broken.append(funk)
+
+    running = {}
+    for funk in todo:
+      submit(funk)
+    while running:
+      done, _ = futures_wait(running, return_when=FIRST_COMPLETED)
+      for f in done:
+        funk = running.pop(f)
+        err = f.exception()
+        if err is None: continue
+        tries[funk] += 1
+        if tries[funk] <= retries and not abort.is_set():
+          log(f'Chunk {funk} failed ({err!r}), retry {tries[funk]} of {retries}')
+          if isinstance(err, BrokenProcessPool): broken.append(funk)
+          else: submit(funk)
+        else:
+          log(f'Chunk {funk} failed ({err!r}), giving up')
+  return broken
+
+def run_serial(run, todo, retries):
+  failed = []
+  for funk in todo:
+    for attempt in range(retries + 1):
+      try:
+        run(funk)
+        break
+      except Exception as err:
+        last = attempt == retries or abort.is_set()
+        log(f'Chunk {funk} failed ({err!r}), ' +
+            ('giving up' if last else f'retry {attempt+1} of {retries}'))
+        if last:
+          failed.append(funk)
+          break
+  return failed
+
+# offsets are BGZF virtual offsets (block << 16 | within) for bgzipped input
+def read_header(vcf, extent=True):
   gz = vcf.endswith('.gz')
-  base = re.sub(r'\.vcf(\.gz)?', "", basename(vcf))
+  bgz = gz and is_bgzf(vcf)
   vcfopen = partial(gzopen, mode='rt') if gz else open
 
   contigs = []
   with vcfopen(vcf) as inp:
-    log('Parsing Header...')
     while True:
       line = inp.readline()
       if line.startswith('##contig'):
@@ -86,96 +497,304 @@ def main():
       data = line.strip().split()
       samples = data[9:]
       break
-    data_top = inp.tell()
-    log(f'Found top of data at byte {data_top}')
-    data_end = inp.seek(0, 2)
-    log(f'Found end of data at byte {data_end}')
+    if not extent:
+      return contigs, samples
+    if not bgz:
+      data_top = inp.tell()
+      data_end = inp.seek(0, 2)
 
-  data_len = data_end - data_top
+  if bgz:
+    with open(vcf, 'rb') as inp:
+      data_top = next(v for v, l in bgzf_lines(inp, 0) if not l.startswith(b'#'))
+    data_end = getsize(vcf) << 16
+  return contigs, samples, data_top, data_end
+
+_INFO_META_ = re.compile(r'(\w+)=("[^"]*"|[^,>]*)')
+
+def read_info_header(vcf):
+  fields = {}
+  with (gzopen(vcf, 'rt') if vcf.endswith('.gz') else open(vcf)) as inp:
+    for line in inp:
+      if not line.startswith('##'): break
+      if line.startswith('##INFO=<'):
+        meta = {k: v.strip('"') for k, v in _INFO_META_.findall(line[8:])}
+        fields[meta['ID']] = meta
+  return fields
+
+# sid, line base, chunk bounds and unfinished chunks of an earlier load of vcf; sid None if new
+def find_source(con, vcf):
+  row = con.execute(_GET_SOURCE_, (abspath(vcf),)).fetchone()
+  if row is None:
+    return None, None, None, None
+  sid, size, mtime, lbase = row
+  st = os.stat(vcf)
+  if (size, mtime) != (st.st_size, int(st.st_mtime)):
+    log(f'{vcf} changed since it was loaded, it cannot be resumed.')
+    sys.exit(1)
+
+  rows = con.execute(_GET_CHUNKS_, (sid,)).fetchall()
+  chunk_bs = [r[1] for r in rows] + [rows[-1][2]]
+  todo = [r[0] for r in rows if not r[3]]
+  return sid, lbase, chunk_bs, todo
+
+# appended loci are numbered after every earlier source's
+def add_source(con, vcf, bgz, data_end, chunk_bs, contigs, samples):
+  con.execute("DROP TABLE IF EXISTS locus_span")
+  lbase, = con.execute("SELECT coalesce(max(base + span), 0) FROM source").fetchone()
+  st = os.stat(vcf)
+  cur = con.execute(_ADD_SOURCE_, (abspath(vcf), st.st_size, int(st.st_mtime),
+                                   int(bgz), lbase, data_end + 1))
+  sid = cur.lastrowid
+  con.executemany(_ADD_CHUNK_, [(sid, i, chunk_bs[i], chunk_bs[i+1])
+                                for i in range(len(chunk_bs)-1)])
 
-  log('Initializing database...')
-  dbn = base + '.v.db'
-  create_database(dbn)
-  con = sqlite3.connect(dbn)
   con.executemany(_ADD_CONTIG_, [(c,) for c in contigs])
-  con.executemany(_ADD_SAMPLE_, [(i, s) for i,s in enumerate(samples)])
+  known = {s for s, in con.execute("SELECT name FROM sample")}
+  ncol, = con.execute("SELECT count(*) FROM sample").fetchone()
+  new = [s for s in samples if s not in known]
+  con.executemany(_ADD_SAMPLE_, [(ncol+i, s) for i,s in enumerate(new)])
   con.commit()
-  con.close()
+  return sid, lbase
 
-  log('Initializing Worker(s)...')
-  global dblock
-  nameq = Queue()
-  for s in random.sample(range(26**2), ncpu):
-    nameq.put_nowait(s)
-
-  conf = (nameq, vcf, dbn, gz, data_top, data_len,
-          chunks if ncpu > 1 else 1,
-          Lock() if ncpu > 1 else None)
+# inclusive locus lines a chunk owns, see read_bgzf_chunk
+def chunk_lines(lbase, bgz, funk, sb, eb):
+  if bgz:
+    return lbase + sb + (funk > 0), lbase + eb
+  return lbase + sb, lbase + eb - 1
 
-  if ncpu == 1:
-    log('Executing in single process.')
-    logfh.close()
+def drop_chunks(con, sid, todo):
+  for funk, in con.execute("SELECT chunk FROM chunk WHERE sid = ? AND NOT done", (sid,)).fetchall():
+    first, last = chunk_range(con, sid, funk)
+    con.execute("DELETE FROM variant WHERE line BETWEEN ? AND ?", (first, last))
+    con.execute("DELETE FROM locus WHERE line BETWEEN ? AND ?", (first, last))
+  con.commit()
 
-    init_worker(*conf)
-    process_vcf_logged()
-  else:
-    log(f'Executing in process pool({ncpu}).')
-    
-    p = Pool(ncpu, initializer=init_worker, initargs=conf)
-    for i in range(chunks):
-      p.apply_async(process_vcf_logged, (i,))
+def chunk_range(con, sid, funk):
+  bgz, lbase, sb, eb = con.execute("""
+                                   SELECT bgzf, base, start, end FROM source JOIN chunk USING (sid)
+                                   WHERE sid = ? AND chunk = ?""", (sid, funk)).fetchone()
+  return chunk_lines(lbase, bgz, funk, sb, eb)
 
-    p.close()
-    p.join()
-    logfh.close()
+# points appended loci already present at the existing locus, in one transaction
+def merge_source(dbn, sid, lbase):
+  con = sqlite3.connect(dbn)
+  con.execute("""
+              CREATE TEMP TABLE remap AS
+              SELECT n.line AS new, min(o.line) AS old
+              FROM locus n JOIN locus o
+                ON o.cid = n.cid AND o.pos = n.pos AND o.ref = n.ref AND o.line < ?
+              WHERE n.line >= ?
+              GROUP BY n.line""", (lbase, lbase))
+  con.execute("CREATE INDEX temp.remap_new ON remap (new)")
+  con.execute("""
+              UPDATE variant SET line = (SELECT old FROM remap WHERE new = variant.line)
+              WHERE line IN (SELECT new FROM remap)""")
+  con.execute("DELETE FROM locus WHERE line IN (SELECT new FROM remap)")
+  con.execute("""
+              UPDATE contig
+              SET loci = (SELECT count(*) FROM locus WHERE locus.cid = contig.cid)""")
+  merged, = con.execute("SELECT count(*) FROM remap").fetchone()
+  con.commit()
+  con.close()
+  return merged
 
 
 def build_name(a: int) -> str:
   return names1[a%26] + '-' + names2[a//26]
 
-def init_worker(nq, v, d, gz, dt, dl, nc, dbl):
-  global name, vcf, vcfopen, data_top, data_len, nchunks, \
-    dbn, dbcon, dbcrs, dblock, transact
+def init_worker(nq, v, gz, bgz, cb, lb, wq, ab, bs, ci, cm, gs, pr, ns, rp, inf, ki):
+  global name, vcf, vcfopen, bgzf, bounds, line_base, writeq, abort, batch_size, \
+    cids, colmap, gtstore, parquet, nsamples, parse_line, info_fields, info_probes, keep_info
   name = build_name(nq.get())
   open_logfh()
 
-  nchunks = nc
-
   vcf = v
-  vcfopen = partial(gzopen, mode='rt') if gz else open
-  data_top = dt
-  data_len = dl
+  vcfopen = partial(gzopen if gz else open, mode='rb')
+  bgzf = bgz
+  bounds = cb
+  line_base = lb
 
-  dbn = d
-  dbcon = sqlite3.connect(dbn)
-  dbcrs = dbcon.cursor()
-  dblock = dbl
-  transact = safe_execute if nchunks > 1 else execute
+  writeq = wq
+  abort = ab
+  batch_size = bs
+  cids = ci
+  colmap = None if cm == list(range(len(cm))) else cm
+  gtstore = gs
+  parquet = pr
+  nsamples = ns
+  parse_line = process_line_reference if rp else process_line_fast
+  info_fields = [(k, t, _INFO_TYPES_[t][1]) for k, t in inf]
+  info_probes = [(f';{k}=', f';{k};', conv) for k, _, conv in info_fields]
+  keep_info = ki
 
 
-def safe_execute(stmt, args, many=False):
+def write_batches_logged(*args):
   try:
-    dblock.acquire()
-    execute(stmt, args, many)
+    write_batches(*args)
   except:
-    log('Bonk')
-    log(sys.exc_info())
-  finally:
-    try:
-      dblock.release()
-    except:
-      log('Bonked')
+    log(traceback.format_exc())
+    raise
+
+# drains the queue once the writer exits, so no worker blocks on it for good
+def watch_writer(writer, abort, wq):
+  wait([writer.sentinel])
+  abort.set()
+  try:
+    while True:
+      wq.get()
+  except Exception:
+    pass # closed as main exits, or torn by a killed worker
+
+# a chunk's done mark and summary counts commit with its last rows;
+# a failed chunk's variants are deleted by rowid, line has no index yet
+def write_batches(dbn, wq, txn, sid, bulk=False):
+  global name
+  name = 'Writer'
+  open_logfh()
 
-def execute(stmt, args, many=False):
-  if many:
-    dbcrs.executemany(stmt, args)
+  con = sqlite3.connect(dbn)
+  if bulk:
+    con.execute("PRAGMA foreign_keys = OFF")
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+    con.execute("PRAGMA cache_size = -262144")
   else:
-    dbcrs.execute(stmt, args)
-  dbcon.commit()
+    con.execute("PRAGMA journal_mode = WAL")
+    con.execute("PRAGMA synchronous = NORMAL")
+  cur = con.cursor()
+  ninfo, = con.execute("SELECT count(*) FROM info_field").fetchone()
+  add_locus = _ADD_LOCUS_.format(', ?' * ninfo)
+  alleles = dict(con.execute("SELECT seq, aid FROM allele"))
+  new = []
+  def intern(seq):
+    aid = alleles.get(seq)
+    if aid is None:
+      aid = alleles[seq] = len(alleles) + 1
+      new.append((aid, seq))
+    return aid
+
+  finished = {c for c, in con.execute("SELECT chunk FROM chunk WHERE sid = ? AND done", (sid,))}
+  wtimes = Counter()
+  vranges = ddict(list)
+  wm = Counter()
+  pending = 0
+  total = 0
+  start_time = datetime.now()
+  tw = perf_counter()
+  while True:
+    t = perf_counter()
+    batch = wq.get()
+    wm['wait_s'] += perf_counter() - t
+    if batch is None: break
+
+    funk, loci, variants = batch
+    if funk in finished:
+      log(f'Ignored a late message for chunk {funk}, it is done')
+      continue
+    if loci is None and variants is None:
+      for lo, hi in vranges.pop(funk, []):
+        cur.execute("DELETE FROM variant WHERE rowid BETWEEN ? AND ?", (lo, hi))
+      cur.execute("DELETE FROM locus WHERE line BETWEEN ? AND ?", chunk_range(con, sid, funk))
+      wtimes.pop(funk, None)
+      commit(con, wm)
+      log(f'{timeform(datetime.now() - start_time)} chunk {funk} failed, its rows were discarded')
+      continue
+    if loci is None:
+      m, stats = variants
+      vranges.pop(funk, None)
+      finished.add(funk)
+      add_summary(cur, *stats)
+      cur.execute(_CHUNK_DONE_, (sid, funk))
+      cur.execute(_ADD_METRIC_, metric_row(sid, funk, m, write_s=wtimes.pop(funk, 0)))
+      commit(con, wm)
+      total += pending
+      pending = 0
+      log(f'{timeform(datetime.now() - start_time)} chunk {funk} done, {total} loci committed')
+      continue
+
+    t = perf_counter()
+    loci = [(l, c, p, intern(r), *rest) for l, c, p, r, *rest in loci]
+    variants = [(intern(a), *rest) for a, *rest in variants]
+    cur.executemany(_ADD_ALLELE_, new)
+    new.clear()
+    cur.executemany(add_locus, loci)
+    top, = cur.execute("SELECT coalesce(max(rowid), 0) FROM variant").fetchone()
+    cur.executemany(_ADD_VARIANT_, variants)
+    if variants:
+      ranges = vranges[funk]
+      if ranges and ranges[-1][1] == top:
+        ranges[-1][1] = top + len(variants)
+      else:
+        ranges.append([top + 1, top + len(variants)])
+    t = perf_counter() - t
+    wtimes[funk] += t
+    wm['write_s'] += t
+    wm['lines'] += len(loci)
+    wm['variants'] += len(variants)
+
+    pending += len(loci)
+    if pending >= txn:
+      commit(con, wm)
+      total += pending
+      pending = 0
+      log(f'{timeform(datetime.now() - start_time)} committed {total} loci')
+
+  commit(con, wm)
+  total += pending
+  wm['wall_s'] = perf_counter() - tw
+  cur.execute(_ADD_METRIC_, metric_row(sid, None, wm, worker='Writer'))
+  con.commit()
+  log(f'{timeform(datetime.now() - start_time)} committed {total} loci, finished')
+  con.close()
+  logfh.close()
+
+
+def add_summary(cur, classes, zygosity, nloci):
+  cur.executemany(_ADD_COUNT_, [(n, cid) for cid, n in nloci.items()])
+  cur.executemany(_ADD_CLASS_COUNT_, [(*k, n) for k, n in classes.items()])
+  rows = ddict(lambda: [0, 0, 0])
+  for (col, cid, code), n in zygosity.items():
+    rows[col, cid][code - 1] = n
+  cur.executemany(_ADD_ZYGOSITY_, [(*k, *v) for k, v in rows.items()])
+
+def commit(con, wm):
+  t = perf_counter()
+  con.commit()
+  wm['commit_s'] += perf_counter() - t
 
+def metric_row(sid, chunk, m, worker=None, **extra):
+  row = {f: m.get(f) for f in _METRIC_FIELDS_}
+  row.update(extra, sid=sid, chunk=chunk, worker=worker or m.get('worker'))
+  return row
 
-def get_chunk_b(funk):
-  return int(data_top + data_len * (funk/nchunks))
+def summarize_metrics(dbn, sid):
+  con = sqlite3.connect(dbn)
+  n, nbytes, lines, variants, read_s, parse_s, store_s, wait_s, write_s, wall_s = con.execute("""
+              SELECT count(*), sum(bytes), sum(lines), sum(variants), sum(read_s),
+                     sum(parse_s), sum(store_s), sum(wait_s), sum(write_s), sum(wall_s)
+              FROM metric WHERE sid = ? AND chunk IS NOT NULL""", (sid,)).fetchone()
+  writer = con.execute("""
+              SELECT wait_s, write_s, commit_s, wall_s
+              FROM metric WHERE sid = ? AND chunk IS NULL
+              ORDER BY rowid DESC LIMIT 1""", (sid,)).fetchone()
+  con.close()
+  if not n or not writer: return
+
+  pct = lambda t, of: f'{100 * (t or 0) / (of or 1):.0f}%'
+  log(f'{n} chunk(s): {(nbytes or 0) / 2**20:.1f} MiB, {lines} lines, {variants} variants')
+  log(f'Parsers ({wall_s:.1f}s summed over chunks): read/decompress {pct(read_s, wall_s)}, parse {pct(parse_s, wall_s)}, '
+      f'genotype store/Parquet {pct(store_s, wall_s)}, waiting on writer {pct(wait_s, wall_s)}')
+  w_wait, w_write, w_commit, w_wall = writer
+  log(f'Writer ({w_wall:.1f}s): insert {pct(w_write, w_wall)}, commit {pct(w_commit, w_wall)}, '
+      f'idle {pct(w_wait, w_wall)}')
+
+  if (wait_s or 0) > 0.25 * wall_s:
+    bound = 'writer (parsers block on a full queue)'
+  elif (read_s or 0) > (parse_s or 0):
+    bound = 'IO/decompression'
+  else:
+    bound = 'parsing (CPU), more workers should help'
+  log(f'Likely bound by {bound}')
 
 
 def open_logfh():
@@ -184,7 +803,7 @@ def open_logfh():
   logfh = open(os.path.join('logs', name + '.log'), 'w+')
 
 def log(message):
-  print(message, file=logfh)
+  print(message, file=logfh, flush=True)
 
 
 def process_vcf_logged(funk=0):
@@ -192,62 +811,346 @@ def process_vcf_logged(funk=0):
   try:
     process_vcf(funk)
   except:
-    log(sys.exc_info())
-  finally:
-    logfh.close()
+    log(traceback.format_exc())
+    discard_chunk(funk)
+    raise
+
+# sent through the queue so the discard follows every batch this worker sent
+def discard_chunk(funk):
+  global chunk_out
+  if chunk_out is not None:
+    chunk_out.close()
+    chunk_out = None
+  if parquet:
+    vpq.drop_chunk(parquet, funk)
+  if gtstore:
+    gts.drop_segments(gtstore, funk)
+  send((funk, None, None))
 
 def timeform(td: timedelta):
-  s = td.total_seconds()
+  s = int(td.total_seconds())
   return f'{s//3600:0>3}:{s//60%60:0>2}:{s%60:0>2}'
 
 def process_vcf(funk=0):
-  log('Assigned chunk '+funk)
-  if nchunks == 1:
-    sb, eb = data_top, data_len + data_top
+  log(f'Assigned chunk {funk}')
+  sb, eb = bounds[funk], bounds[funk+1]
+  if bgzf:
+    lines = read_bgzf_chunk(sb, eb, skip=funk > 0)
+    shift = 16
   else:
-    sb = get_chunk_b(funk)
-    eb = get_chunk_b(funk+1)
+    lines = read_plain_chunk(sb, eb)
+    shift = 0
 
-  loci = 0
-  lxrm = None
-  cid = None
+  loci, variants = [], []
+  calls = ddict(lambda: ([], []))
+  stats = Counter(), Counter(), Counter()
+  out = new_chunk_out(funk)
   lcomp = 0
   start_time = datetime.now()
+  m = Counter()
+  t0 = tw = perf_counter()
+  for off, line in lines:
+    t1 = perf_counter()
+    m['read_s'] += t1 - t0
+    m['bytes'] += len(line)
+    m['lines'] += 1
+    xrm, pos, ref, info, vrts, missing = parse_line(line.decode())
+    m['variants'] += len(vrts)
+    cid = cids[xrm]
+    lid = off + line_base
+    loci.append((lid, cid, pos, ref, *parse_info(info)))
+    stats[2][cid] += 1
+    if colmap:
+      lvars = [(a, class_code[c], colmap[i], lid) for a, c, i in vrts]
+      tally(stats, cid, lvars, [colmap[i] for i in missing])
+    else:
+      lvars = [(a, class_code[c], i, lid) for a, c, i in vrts]
+      tally(stats, cid, lvars, missing)
+    variants += lvars
+    if gtstore:
+      dose = bytearray(nsamples)
+      for _, _, c in vrts: dose[c] = min(dose[c] + 1, gts.HOM_ALT)
+      for c in missing: dose[c] = gts.MISSING
+      calls[cid][0].append(lid)
+      calls[cid][1].append(dose)
+    t0 = perf_counter()
+    m['parse_s'] += t0 - t1
+    if len(loci) >= batch_size:
+      emit(out, m, (funk, loci, variants))
+      loci, variants = [], []
+      flush_calls(funk, calls, m)
+      t0 = perf_counter()
+
+    ccomp = int(((off>>shift) - (sb>>shift)) / ((eb>>shift) - (sb>>shift) or 1) *100)
+    if ccomp > lcomp:
+      lcomp = ccomp
+      tdiff = datetime.now() - start_time
+      human_time = timeform(tdiff)
+      log(f'{human_time} {lcomp: >3}%')
+
+  if loci:
+    emit(out, m, (funk, loci, variants))
+  flush_calls(funk, calls, m)
+  close_export(out, m)
+  m['wall_s'] = perf_counter() - tw
+  m['worker'] = name
+  send((funk, None, (m, stats)))
+
+
+def process_merge_logged(vcfs, colmaps):
+  log(f'{name} Reporting for duty!')
+  try:
+    process_merge(vcfs, colmaps)
+  except:
+    log(traceback.format_exc())
+    discard_chunk(0)
+    raise
+
+# records at one position are sorted by ref and alt, as heapq.merge needs
+def merge_stream(fn, i, rank):
+  last, held = (-1, 0), []
+  with (gzopen(fn, 'rt') if fn.endswith('.gz') else open(fn)) as inp:
+    for line in inp:
+      if line.startswith('#'): continue
+      data = line.split('\t', 5)
+      key = rank[data[0]], int(data[1])
+      if key < last:
+        raise ValueError(f'{fn} is not sorted at {data[0]}:{data[1]}')
+      if key != last:
+        yield from sorted(held)
+        held = []
+      last = key
+      held.append((*key, data[3].lower(), data[4].lower(), i, line))
+  yield from sorted(held)
+
+# records sharing contig, pos and ref become one locus; INFO comes from the first input having it
+def process_merge(vcfs, colmaps):
+  log(f'Merging {len(vcfs)} VCFs')
+  # contig ids follow header order
+  streams = [merge_stream(fn, i, cids) for i, fn in enumerate(vcfs)]
+
+  loci, variants = [], []
+  calls = ddict(lambda: ([], []))
+  stats = Counter(), Counter(), Counter()
+  out = new_chunk_out(0)
+  lid = line_base
+  start_time = datetime.now()
+  m = Counter()
+  t0 = tw = perf_counter()
+  for _, group in groupby(heapq.merge(*streams), key=itemgetter(0, 1, 2)):
+    group = list(group)
+    t1 = perf_counter()
+    m['read_s'] += t1 - t0
+    info = None
+    cid = group[0][0]
+    if gtstore:
+      dose = bytearray([gts.MISSING]) * nsamples
+      # once per input, which may have several records here (split multiallelics)
+      for i in {g[-2] for g in group}:
+        for c in colmaps[i]: dose[c] = gts.HOM_REF
+    gvars, gmissing = [], {}
+    for *_, i, line in group:
+      m['bytes'] += len(line)
+      m['lines'] += 1
+      xrm, pos, ref, linfo, vrts, missing = parse_line(line)
+      m['variants'] += len(vrts)
+      cm = colmaps[i]
+      if info is None: info = linfo
+      lvars = [(a, class_code[c], cm[j], lid) for a, c, j in vrts]
+      gvars += lvars
+      gmissing.update((cm[j], None) for j in missing)
+      if gtstore:
+        for _, _, j in vrts: dose[cm[j]] = min(dose[cm[j]] + 1, gts.HOM_ALT)
+        for j in missing: dose[cm[j]] = gts.MISSING
+    tally(stats, cid, gvars, list(gmissing))
+    variants += gvars
+
+    loci.append((lid, cid, pos, ref, *parse_info(info)))
+    stats[2][cid] += 1
+    if gtstore:
+      calls[cid][0].append(lid)
+      calls[cid][1].append(dose)
+    lid += 1
+    t0 = perf_counter()
+    m['parse_s'] += t0 - t1
+
+    if len(loci) >= batch_size:
+      emit(out, m, (0, loci, variants))
+      loci, variants = [], []
+      flush_calls(0, calls, m)
+      log(f'{timeform(datetime.now() - start_time)} {lid - line_base} loci merged')
+      t0 = perf_counter()
+
+  if loci:
+    emit(out, m, (0, loci, variants))
+  flush_calls(0, calls, m)
+  close_export(out, m)
+  m['wall_s'] = perf_counter() - tw
+  m['worker'] = name
+  send((0, None, (m, stats)))
+  log(f'{timeform(datetime.now() - start_time)} {lid - line_base} loci merged, finished')
+
+
+# (column, cid, class) -> calls and (column, cid, zygosity code) -> loci
+def tally(stats, cid, lvars, missing):
+  classes, zygosity, _ = stats
+  classes.update((col, cid, cl) for _, cl, col, _ in lvars)
+  for col, n in Counter(col for _, _, col, _ in lvars).items():
+    zygosity[col, cid, min(n, gts.HOM_ALT)] += 1
+  zygosity.update((col, cid, gts.MISSING) for col in missing)
+
+# finds each --info key by substring, so wide INFO columns are never split
+def parse_info(info):
+  if not info_fields:
+    return info,
+  s = ';' + info + ';'
+  vals = []
+  for probe, flag, conv in info_probes:
+    i = s.find(probe)
+    if i >= 0:
+      i += len(probe)
+      vals.append(conv(s[i:s.index(';', i)]))
+    else:
+      vals.append(conv('' if flag in s else None))
+  return (info if keep_info else None), *vals
+
+def emit(out, m, batch):
+  if out is None:
+    return put_batch(m, batch)
+  t = perf_counter()
+  out.add(*batch[1:])
+  m['store_s'] += perf_counter() - t
+
+def new_chunk_out(funk):
+  global chunk_out
+  chunk_out = vpq.ChunkWriter(parquet, funk, cids, info_fields) if parquet else None
+  return chunk_out
+
+def close_export(out, m):
+  global chunk_out
+  chunk_out = None
+  if out is None: return
+  t = perf_counter()
+  out.close()
+  m['store_s'] += perf_counter() - t
+
+def put_batch(m, batch):
+  # blocks while the writer is behind, the old lock wait
+  t = perf_counter()
+  send(batch)
+  m['wait_s'] += perf_counter() - t
+
+# raises instead of blocking for good once the writer is gone
+def send(item):
+  while True:
+    if abort.is_set():
+      raise RuntimeError('The writer has stopped')
+    try:
+      writeq.put(item, timeout=1)
+      return
+    except queue.Full:
+      pass
+
+def flush_calls(funk, calls, m):
+  t = perf_counter()
+  for cid, (lids, doses) in calls.items():
+    codes = np.frombuffer(b''.join(doses), dtype=np.uint8).reshape(len(doses), nsamples)
+    gts.write_segment(gtstore, funk, cid, lids, codes)
+  calls.clear()
+  m['store_s'] += perf_counter() - t
+
+
+def read_plain_chunk(sb, eb):
   with vcfopen(vcf) as inp:
     inp.seek(sb-1)
-    if inp.read(1) != '\n': inp.readline()
-
-    while inp.tell() < eb:
+    if inp.read(1) != b'\n': inp.readline()
 
+    # track offsets by hand, tell() costs as much as parsing the line
+    lid = inp.tell()
+    while lid < eb:
       line = inp.readline()
-      xrm, pos, ref, info, vrts = process_line(line)
-
-      # contig transition
-      if xrm != lxrm:
-        if lxrm:
-          transact(_ADD_COUNT_, (loci, cid))
-          loci = 0
-        transact(_GET_CONTIG_ID_, (xrm,))
-        fetch = dbcrs.fetchone()
-        cid = int(fetch[0])
-        lxrm = xrm
-
-      loci += 1
-      transact(_ADD_LOCUS_, (cid, pos, ref, info))
-      lid = dbcrs.lastrowid
-      transact(_ADD_VARIANT_, [(*acs, lid) for acs in vrts], many=True)
-
-      ccomp = int((inp.tell()-sb) / (eb-sb) *100)
-      if ccomp > lcomp:
-        lcomp = ccomp
-        tdiff = datetime.now() - start_time
-        human_time = timeform(tdiff)
-        log(f'{human_time} {lcomp: >3}%')
-
-    if lxrm:
-      transact(_ADD_COUNT_, (loci, cid))
-    
-  dbcon.close()
+      if not line: break
+      yield lid, line
+      lid += len(line)
+
+# like a Hadoop split, each chunk but the first drops its first line and reads
+# through the line starting at eb, so lines spanning blocks are read once
+def read_bgzf_chunk(sb, eb, skip=True):
+  with open(vcf, 'rb') as inp:
+    lines = bgzf_lines(inp, sb)
+    if skip: next(lines, None)
+    for lid, line in lines:
+      if lid > eb: break
+      yield lid, line
+
+
+_BGZF_HEAD_ = b'\x1f\x8b\x08\x04'
+_BGZF_XTRA_ = b'\x06\x00BC\x02\x00'
+
+def is_bgzf_head(head):
+  return len(head) >= 18 and head[:4] == _BGZF_HEAD_ and head[10:16] == _BGZF_XTRA_
+
+def is_bgzf(fn):
+  with open(fn, 'rb') as inp:
+    return is_bgzf_head(inp.read(18))
+
+def bgzf_blocks(inp, coff):
+  inp.seek(coff)
+  while len(head := inp.read(18)) == 18:
+    bsize = int.from_bytes(head[16:18], 'little') + 1
+    body = inp.read(bsize - 18)
+    yield coff, zlib.decompress(body[:-8], -15)
+    coff += bsize
+
+# a line's offset is that of its first byte, even when it spans blocks
+def bgzf_lines(inp, voff):
+  carry, cvoff = b'', None
+  within = voff & 0xffff
+  for coff, data in bgzf_blocks(inp, voff >> 16):
+    i, within = within, 0
+    while (j := data.find(b'\n', i)) >= 0:
+      if carry:
+        yield cvoff, carry + data[i:j+1]
+        carry = b''
+      else:
+        yield coff << 16 | i, data[i:j+1]
+      i = j + 1
+    if i < len(data):
+      if not carry: cvoff = coff << 16 | i
+      carry += data[i:]
+  if carry:
+    yield cvoff, carry
+
+# a BGZF header only counts if another one, or the end of file, follows it
+def next_bgzf_block(inp, coff, size):
+  while coff < size:
+    inp.seek(coff)
+    window = inp.read(1 << 17)
+    i = 0
+    while (i := window.find(_BGZF_HEAD_, i)) >= 0:
+      head = window[i:i+18]
+      if len(head) < 18: break
+      if is_bgzf_head(head):
+        bnext = coff + i + int.from_bytes(head[16:18], 'little') + 1
+        inp.seek(bnext)
+        if bnext == size or is_bgzf_head(inp.read(18)):
+          return coff + i
+      i += 1
+    if len(window) <= 18: break
+    coff += len(window) - 18
+  return size
+
+def plan_bgzf_chunks(fn, data_top, nchunks):
+  size = getsize(fn)
+  top = data_top >> 16
+  chunk_bs = [data_top]
+  with open(fn, 'rb') as inp:
+    for k in range(1, nchunks):
+      b = next_bgzf_block(inp, int(top + (size - top) * k/nchunks), size)
+      if b << 16 > chunk_bs[-1] and b < size:
+        chunk_bs.append(b << 16)
+  chunk_bs.append(size << 16)
+  return chunk_bs
 
 
 def tabulate_rowform(form, sample_data):
@@ -273,6 +1176,52 @@ def process_line(line):
 
   return xrm, pos, ref, info, vrts
 
+def process_line_reference(line):
+  return *process_line(line), []
+
+_GT_SPLIT_ = re.compile(r'[/|]')
+gt_cache = {}
+
+def parse_gt(gt):
+  als = _GT_SPLIT_.split(gt)
+  called = [a for a in als if a != '.']
+  return tuple(int(a)-1 for a in called if a != '0'), not called
+
+# process_line plus missing columns, each distinct GT string parsed once per line
+def process_line_fast(line):
+  data = line.rstrip('\n').split('\t')
+  xrm, pos = data[0:2]
+  ref = data[3].lower()
+  alts = [a.lower() for a in data[4].split(',')]
+  alcs = [vrt_type(ref, a) for a in alts]
+  info = data[7]
+
+  form = data[8].split(':')
+  gi = form.index('GT') if 'GT' in form else None
+  if gi == 0:
+    gtl = [s.partition(':')[0] for s in data[9:]]
+  elif gi is None:
+    gtl = ['.'] * len(data[9:])
+  else:
+    gtl = []
+    for s in data[9:]:
+      sf = s.split(':', gi+1)
+      gtl.append(sf[gi] if len(sf) > gi else '.')
+
+  vrts = []
+  missing = []
+  for i, gt in enumerate(gtl):
+    parsed = gt_cache.get(gt)
+    if parsed is None:
+      parsed = gt_cache[gt] = parse_gt(gt)
+    vals, miss = parsed
+    if vals:
+      vrts += [(alts[a], alcs[a], i) for a in vals]
+    elif miss:
+      missing.append(i)
+
+  return xrm, pos, ref, info, vrts, missing
+
 tshape = {'a': 'ag', 'g': 'ag', 'c': 'ct', 't': 'ct'}
 
 def vrt_type(ref, alt):
@@ -305,7 +1254,7 @@ def check_line(line):
   return xrm, pos, form, missing
 
 
-def create_database(dbn):
+def create_database(dbn, info_spec=()):
   if exists(dbn):
     os.remove(dbn)
 
@@ -325,9 +1274,30 @@ def create_database(dbn):
                 line INTEGER PRIMARY KEY,
                 cid REFERENCES contig,
                 pos INT,
-                ref VARCHAR(20),
-                info VARCHAR(100)
+                ref INT REFERENCES allele,
+                info VARCHAR(100){}
+              )""".format(''.join(f',\n                "info_{k}" {_INFO_TYPES_[t][0]}' for k, t in info_spec)))
+
+  cur.execute("""
+              CREATE TABLE info_field(
+                key VARCHAR(40) PRIMARY KEY,
+                type VARCHAR(10)
               )""")
+  cur.executemany(_ADD_INFO_FIELD_, info_spec)
+
+  # every distinct ref and alt sequence, so locus and variant store ids
+  cur.execute("""
+              CREATE TABLE allele(
+                aid INTEGER PRIMARY KEY,
+                seq VARCHAR(20) UNIQUE
+              )""")
+
+  cur.execute("""
+              CREATE TABLE class(
+                code INTEGER PRIMARY KEY,
+                name CHAR(2)
+              )""")
+  cur.executemany("INSERT INTO class VALUES (?, ?)", enumerate(_CLASSES_))
   
   cur.execute("""
               CREATE TABLE sample(
@@ -335,10 +1305,70 @@ def create_database(dbn):
                 name VARCHAR(20)
               )""")
   
+  cur.execute("""
+              CREATE TABLE source(
+                sid INTEGER PRIMARY KEY,
+                path VARCHAR(200) UNIQUE,
+                size INT,
+                mtime INT,
+                bgzf INT,
+                base INT,
+                span INT
+              )""")
+
+  # per chunk load telemetry, chunk is null for the writer's own row
+  cur.execute("""
+              CREATE TABLE metric(
+                sid INT REFERENCES source,
+                chunk INT,
+                worker VARCHAR(20),
+                bytes INT,
+                lines INT,
+                variants INT,
+                read_s REAL,
+                parse_s REAL,
+                store_s REAL,
+                wait_s REAL,
+                write_s REAL,
+                commit_s REAL,
+                wall_s REAL
+              )""")
+
+  # kept by the loader alongside variant so summaries need no scan of it
+  cur.execute("""
+              CREATE TABLE sample_class(
+                column INT REFERENCES sample,
+                cid INT REFERENCES contig,
+                class INT REFERENCES class,
+                calls INT,
+                PRIMARY KEY (column, cid, class)
+              )""")
+
+  cur.execute("""
+              CREATE TABLE sample_zygosity(
+                column INT REFERENCES sample,
+                cid INT REFERENCES contig,
+                het INT,
+                hom_alt INT,
+                missing INT,
+                PRIMARY KEY (column, cid)
+              )""")
+
+  # start/end are offsets in the source, see chunk_lines for the lines owned
+  cur.execute("""
+              CREATE TABLE chunk(
+                sid INT REFERENCES source,
+                chunk INT,
+                start INT,
+                end INT,
+                done INT,
+                PRIMARY KEY (sid, chunk)
+              )""")
+
   cur.execute("""
               CREATE TABLE variant(
-                alt VARCHAR(20),
-                class CHAR(2),
+                alt INT REFERENCES allele,
+                class INT REFERENCES class,
                 column INT REFERENCES sample,
                 line INT REFERENCES locus
               )""")
@@ -346,9 +1376,23 @@ def create_database(dbn):
   con.commit()
   con.close()
 
+def create_indexes(dbn):
+  con = sqlite3.connect(dbn)
+  con.execute("PRAGMA temp_store = MEMORY")
+  con.execute("PRAGMA cache_size = -262144")
+  for stmt in _INDEXES_ + _SPAN_INDEX_:
+    con.execute(stmt)
+  for key, kind in con.execute("SELECT key, type FROM info_field").fetchall():
+    if kind != 'str':
+      con.execute(f'CREATE INDEX IF NOT EXISTS "locus_info_{key}" ON locus ("info_{key}")')
+  con.execute("ANALYZE")
+  con.commit()
+  con.close()
+
 
 if __name__ == '__main__':
   main()
 
 # python variant_database.py "..\misc_data\1KGQ_common_pop_phased.vcf.gz" 6 100
+# python variant_database.py "..\misc_data\1KGQ_common_pop_phased.vcf.gz" 6 100 --batch 5000 --txn 500000
 # python variant_database.py "..\multi_ancestry_prs\vcf_inspection\hg00188.vcf.gz" 6 6
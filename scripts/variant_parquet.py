@@ -0,0 +1,114 @@
+"""
+Parquet export of the locus and variant tables, beside a variant database.
+
+Each table is a hive-partitioned dataset with one directory per contig, and
+every load chunk writes its own <chunk>.parquet file in each:
+
+  <base>.parquet/locus/contig=chr1/<chunk>.parquet     line, pos, ref, info, info_*
+  <base>.parquet/variant/contig=chr1/<chunk>.parquet   line, column, alt, class
+  <base>.parquet/{sample,contig,class}.parquet         copied from the database
+
+Alleles stay strings, Parquet dictionary-encodes them; class is the code of
+the class table.
+
+Read with predicate pushdown on contig and only the columns needed:
+
+  pd.read_parquet('1KGQ_common_pop_phased.parquet/variant',
+                  columns=['line', 'class'], filters=[('contig', '=', 'chr1')])
+"""
+import os, shutil, sqlite3
+from os.path import join, exists
+from glob import glob
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+_LOCUS_ = pa.schema([('line', pa.int64()), ('pos', pa.int32()),
+                     ('ref', pa.string()), ('info', pa.string())])
+_VARIANT_ = pa.schema([('line', pa.int64()), ('column', pa.int32()),
+                       ('alt', pa.string()), ('class', pa.int8())])
+_INFO_TYPES_ = {'int': pa.int64(), 'float': pa.float64(), 'str': pa.string(), 'flag': pa.int8()}
+
+# rows buffered per contig before a row group is written
+_ROW_GROUP_ = 1 << 17
+
+
+def chunk_file(root, table, contig, chunk):
+  return join(root, table, f'contig={contig}', f'{chunk}.parquet')
+
+def create_export(root):
+  if exists(root):
+    shutil.rmtree(root)
+  os.makedirs(root)
+
+def drop_chunk(root, chunk):
+  """
+  Deletes the chunk's locus and variant file in every contig partition.
+  """
+  for fn in glob(join(root, '*', 'contig=*', f'{chunk}.parquet')):
+    os.remove(fn)
+
+def write_tables(root, dbn):
+  """
+  Copies the small contig, sample and class tables next to the datasets.
+  """
+  con = sqlite3.connect(dbn)
+  for table, stmt in [('contig', "SELECT cid, name, loci FROM contig ORDER BY cid"),
+                      ('sample', "SELECT column, name FROM sample ORDER BY column"),
+                      ('class', "SELECT code, name FROM class ORDER BY code")]:
+    cur = con.execute(stmt)
+    cols = [d[0] for d in cur.description]
+    rows = cur.fetchall()
+    pq.write_table(pa.table({c: [r[i] for r in rows] for i, c in enumerate(cols)}),
+                   join(root, f'{table}.parquet'))
+  con.close()
+
+
+class ChunkWriter:
+  """
+  Buffers one chunk's rows per contig and writes them as row groups of
+  that chunk's files, opening each file on its first rows.
+  """
+  def __init__(self, root, chunk, contigs: dict, info_fields=()):
+    self.root = root
+    self.locus = pa.schema(list(_LOCUS_) + [(f'info_{k}', _INFO_TYPES_[t])
+                                            for k, t, *_ in info_fields])
+    self.chunk = chunk
+    self.names = {cid: c for c, cid in contigs.items()}
+    self.writers = {}
+    self.loci = {}
+    self.variants = {}
+
+  def add(self, loci, variants):
+    """
+    loci and variants as the writer gets them, _ADD_LOCUS_ and _ADD_VARIANT_ rows.
+    """
+    lcid = {}
+    for line, cid, pos, *rest in loci:
+      lcid[line] = cid
+      self.loci.setdefault(cid, []).append((line, int(pos), *rest))
+    for alt, cl, col, line in variants:
+      self.variants.setdefault(lcid[line], []).append((line, col, alt, cl))
+    for cid in list(self.loci):
+      if len(self.loci[cid]) >= _ROW_GROUP_ or len(self.variants.get(cid, ())) >= 8*_ROW_GROUP_:
+        self.flush(cid)
+
+  def flush(self, cid):
+    for table, schema, rows in [('locus', self.locus, self.loci.pop(cid, [])),
+                                ('variant', _VARIANT_, self.variants.pop(cid, []))]:
+      if not rows: continue
+      key = table, cid
+      if key not in self.writers:
+        fn = chunk_file(self.root, table, self.names[cid], self.chunk)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        self.writers[key] = pq.ParquetWriter(fn, schema)
+      cols = list(zip(*rows))
+      self.writers[key].write_table(pa.Table.from_arrays(
+        [pa.array(c, type=f.type) for c, f in zip(cols, schema)], schema=schema))
+
+  def close(self):
+    for cid in set(self.loci) | set(self.variants):
+      self.flush(cid)
+    for w in self.writers.values():
+      w.close()
+    self.writers.clear()
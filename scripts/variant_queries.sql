@@ -1,2 +1,30 @@
 select count(*)
 from variant
+
+-- variant and locus store allele ids and class codes, join for the text
+select contig.name, pos, r.seq as ref, a.seq as alt, class.name as class
+from variant
+  join locus using (line)
+  join contig using (cid)
+  join allele r on r.aid = locus.ref
+  join allele a on a.aid = variant.alt
+  join class on class.code = variant.class
+limit 10
+
+-- the loader keeps sample_class and sample_zygosity, these need no scan of variant
+
+-- Ts/Tv per sample
+select name, sum(calls * (class = 0)) * 1.0 / sum(calls * (class = 1)) as tstv
+from sample_class join sample using (column)
+group by column
+
+-- indels per contig
+select contig.name, sum(calls)
+from sample_class join contig using (cid)
+where class in (select code from class where name in ('in', 'de'))
+group by cid
+
+-- het/hom ratio per sample
+select name, sum(het) * 1.0 / sum(hom_alt) as het_hom, sum(missing) as missing
+from sample_zygosity join sample using (column)
+group by column
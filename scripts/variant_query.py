@@ -0,0 +1,241 @@
+"""
+Region and sample queries over a database written by variant_database.py.
+
+Regions are (contig, start, end), 1-based and inclusive like VCF positions,
+or 'chr1:100-200' strings; a locus is in a region if any base of its ref
+overlaps it. Overlaps go through the locus_span R*Tree built with the other
+indexes, or a position range scan on databases loaded with --no-index.
+
+  vq = VariantQuery('1KGQ_common_pop_phased.v.db')
+  vq.fetch_region('chr1', 10000, 20000)    # calls in a region
+  vq.fetch_samples(['HG00188'], region)    # calls of some samples
+  vq.class_counts(region)                  # {class: calls}
+  vq.fetch_bed('capture.bed', samples)     # calls in any bed interval
+"""
+from argparse import ArgumentParser
+import sys, sqlite3, re
+from datetime import datetime
+
+# one row per call; CROSS JOIN keeps variant first, the planner otherwise
+# likes to scan the small lookup tables and probe locus by ref
+_CALL_COLUMNS_ = ['contig', 'pos', 'ref', 'alt', 'class', 'sample', 'line']
+_CALLS_ = """
+          SELECT contig.name, locus.pos, r.seq, a.seq, class.name,
+                 sample.name, locus.line
+          FROM variant
+            CROSS JOIN locus ON locus.line = variant.line
+            CROSS JOIN contig ON contig.cid = locus.cid
+            CROSS JOIN allele r ON r.aid = locus.ref
+            CROSS JOIN allele a ON a.aid = variant.alt
+            CROSS JOIN class ON class.code = variant.class
+            CROSS JOIN sample ON sample.column = variant.column
+          WHERE {where}
+          ORDER BY locus.line, variant.column"""
+
+_COUNTS_ = """
+           SELECT class.name, count(*) FROM variant JOIN class ON class.code = variant.class
+           WHERE {where} GROUP BY variant.class"""
+_SUMMARY_COUNTS_ = """
+                   SELECT class.name, sum(calls) FROM sample_class JOIN class ON class.code = class
+                   WHERE {where} GROUP BY class"""
+
+_SPAN_ = """
+         SELECT line FROM locus_span
+         WHERE cid0 <= :cid AND cid1 >= :cid AND lo <= :end AND hi >= :start"""
+
+# same overlap without the R*Tree; a locus starts at most maxref-1 bases before :start
+_SPAN_SCAN_ = """
+              SELECT line FROM locus JOIN allele ON aid = ref
+              WHERE cid = :cid AND pos BETWEEN :start - :maxref + 1 AND :end
+                AND pos + length(seq) - 1 >= :start"""
+
+_REGION_ = re.compile(r'^([^:]+):([\d,]+)-([\d,]+)$')
+
+
+def parse_region(region):
+  """
+  (contig, start, end) or 'contig:start-end' -> (contig, start, end)
+  """
+  if isinstance(region, str):
+    m = _REGION_.match(region)
+    if m is None:
+      raise ValueError(f'Bad region {region}, expected contig:start-end')
+    c, s, e = m.groups()
+    return c, int(s.replace(',', '')), int(e.replace(',', ''))
+  c, s, e = region
+  return c, int(s), int(e)
+
+def read_bed(bed):
+  """
+  Yields the intervals of a bed file as 1-based inclusive regions.
+  """
+  with open(bed) as inp:
+    for l in inp:
+      if not l.strip() or l.startswith(('#', 'track', 'browser')): continue
+      c, s, e = l.split('\t', 3)[:3]
+      yield c, int(s) + 1, int(e)
+
+
+class VariantQuery:
+  def __init__(self, dbn):
+    self.con = sqlite3.connect(dbn)
+    self.con.execute("PRAGMA temp_store = MEMORY")
+    self.cids = dict(self.con.execute("SELECT name, cid FROM contig"))
+    self.columns = dict(self.con.execute("SELECT name, column FROM sample"))
+    self.spans, = self.con.execute("""
+                                   SELECT count(*) FROM sqlite_master
+                                   WHERE name = 'locus_span'""").fetchone()
+    self._maxref = None
+
+  def close(self):
+    self.con.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def maxref(self):
+    if self._maxref is None:
+      # over alts too, still a bound and the allele table is small
+      self._maxref, = self.con.execute("SELECT coalesce(max(length(seq)), 1) FROM allele").fetchone()
+    return self._maxref
+
+  def sample_columns(self, names):
+    missing = [s for s in names if s not in self.columns]
+    if missing:
+      raise KeyError(f'Samples not in the database: {", ".join(missing)}')
+    return [self.columns[s] for s in names]
+
+  def region_filter(self, region, params):
+    """
+    Condition on variant.line selecting loci that overlap region, None if
+    its contig is not in the database.
+    """
+    c, s, e = parse_region(region)
+    if c not in self.cids:
+      return None
+    params.update({'cid': self.cids[c], 'start': s, 'end': e})
+    if self.spans:
+      return f'variant.line IN ({_SPAN_})'
+    params['maxref'] = self.maxref()
+    return f'variant.line IN ({_SPAN_SCAN_})'
+
+  def sample_filter(self, samples, params):
+    if samples is None:
+      return '1'
+    cols = self.sample_columns(samples)
+    params.update({f's{i}': c for i, c in enumerate(cols)})
+    return f"variant.column IN ({', '.join(f':s{i}' for i in range(len(cols)))})"
+
+  def fetch_region(self, contig, start, end, samples=None):
+    """
+    Calls at loci overlapping contig:start-end, as _CALL_COLUMNS_ tuples in
+    file order, optionally only those of the named samples.
+    """
+    params = {}
+    span = self.region_filter((contig, start, end), params)
+    if span is None:
+      return []
+    where = span + ' AND ' + self.sample_filter(samples, params)
+    return self.con.execute(_CALLS_.format(where=where), params).fetchall()
+
+  def fetch_samples(self, names, region=None):
+    """
+    Calls of the named samples, in one region or across the whole database.
+    """
+    if region is not None:
+      return self.fetch_region(*parse_region(region), samples=names)
+    params = {}
+    where = self.sample_filter(names, params)
+    return self.con.execute(_CALLS_.format(where=where), params).fetchall()
+
+  def class_counts(self, region=None, samples=None):
+    """
+    {variant class: calls} in region (the whole database if None), optionally
+    only counting the named samples. Whole database counts come from the
+    loader's sample_class summary, without scanning variant.
+    """
+    params = {}
+    where = self.sample_filter(samples, params)
+    if region is None:
+      stmt = _SUMMARY_COUNTS_.format(where=where.replace('variant.', ''))
+      return dict(self.con.execute(stmt, params).fetchall())
+
+    span = self.region_filter(region, params)
+    if span is None:
+      return {}
+    where = span + ' AND ' + where
+    return dict(self.con.execute(_COUNTS_.format(where=where), params).fetchall())
+
+  def fetch_bed(self, regions, samples=None):
+    """
+    Calls at loci overlapping any of regions (or the intervals of a bed file
+    if given a path), each call once, in file order. The regions go through
+    a temp table so the whole set is one join against the span index.
+    """
+    if isinstance(regions, str):
+      regions = read_bed(regions)
+    rows = [(self.cids[c], s, e) for c, s, e in map(parse_region, regions) if c in self.cids]
+
+    self.con.execute("DROP TABLE IF EXISTS temp.region")
+    self.con.execute("CREATE TEMP TABLE region(cid INT, start INT, end INT)")
+    self.con.executemany("INSERT INTO temp.region VALUES (?, ?, ?)", rows)
+    params = {}
+    if self.spans:
+      span = """
+             SELECT s.line FROM temp.region r JOIN locus_span s
+               ON s.cid0 <= r.cid AND s.cid1 >= r.cid AND s.lo <= r.end AND s.hi >= r.start"""
+    else:
+      span = """
+             SELECT l.line FROM temp.region r JOIN locus l JOIN allele
+               ON l.cid = r.cid AND l.pos BETWEEN r.start - :maxref + 1 AND r.end
+                 AND aid = l.ref AND l.pos + length(seq) - 1 >= r.start"""
+      params['maxref'] = self.maxref()
+    where = f'variant.line IN ({span}) AND ' + self.sample_filter(samples, params)
+    return self.con.execute(_CALLS_.format(where=where), params).fetchall()
+
+
+def make_argparse():
+  clap = ArgumentParser(prog='variant_query.py',
+                        description='Print the calls in a region or bed file of a variant database')
+  clap.add_argument('database',
+                    help='.v.db written by variant_database.py')
+  clap.add_argument('region',
+                    help='contig:start-end (1-based, inclusive) or a bed file')
+  clap.add_argument('-s', '--samples', nargs='+', default=None,
+                    help='only calls of these samples')
+  clap.add_argument('-c', '--counts', action='store_true',
+                    help='print calls per variant class instead')
+  return clap
+
+def main():
+  args = make_argparse().parse_args()
+  start_time = datetime.now()
+  with VariantQuery(args.database) as vq:
+    if _REGION_.match(args.region):
+      if args.counts:
+        rows = sorted(vq.class_counts(args.region, args.samples).items())
+      else:
+        rows = vq.fetch_region(*parse_region(args.region), samples=args.samples)
+    elif args.counts:
+      counts = {}
+      for region in read_bed(args.region):
+        for k, n in vq.class_counts(region, args.samples).items():
+          counts[k] = counts.get(k, 0) + n
+      rows = sorted(counts.items())
+    else:
+      rows = vq.fetch_bed(args.region, args.samples)
+
+  print('\t'.join(['class', 'calls'] if args.counts else _CALL_COLUMNS_))
+  for r in rows:
+    print('\t'.join(map(str, r)))
+  print(f'{len(rows)} rows in {(datetime.now() - start_time).total_seconds():.3f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
+
+# python variant_query.py 1KGQ_common_pop_phased.v.db chr1:1000000-2000000 -s HG00188
+# python variant_query.py 1KGQ_common_pop_phased.v.db ..\sample_level\capture_intervals\test.bed --counts